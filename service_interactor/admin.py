@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Scope, UserProviderScope
+from .models import Scope, SyncCheckpoint, UserProviderScope
 
 
 @admin.register(Scope)
@@ -14,3 +14,9 @@ class ScopeAdmin(admin.ModelAdmin):
 class UserProviderScopeAdmin(admin.ModelAdmin):
     list_display = ['account', 'scope']
     list_filter = ['account']
+
+
+@admin.register(SyncCheckpoint)
+class SyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['service', 'kind', 'key', 'updated']
+    list_filter = ['kind']
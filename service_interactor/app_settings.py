@@ -0,0 +1,51 @@
+from django.conf import settings
+
+
+class AppSettings(object):
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def _setting(self, name, default):
+        return getattr(settings, self.prefix + name, default)
+
+    @property
+    def REGISTRY_CACHE(self):
+        """ Keep a snapshot of each users service registry in the Django cache between requests. """
+        return self._setting('REGISTRY_CACHE', False)
+
+    @property
+    def REGISTRY_CACHE_TIMEOUT(self):
+        return self._setting('REGISTRY_CACHE_TIMEOUT', 60 * 60)
+
+    @property
+    def HTTP_POOL_CONNECTIONS(self):
+        """ Number of hosts to keep a connection pool for in the shared HTTP session. """
+        return self._setting('HTTP_POOL_CONNECTIONS', 10)
+
+    @property
+    def HTTP_POOL_MAXSIZE(self):
+        """ Maximum connections kept alive per host in the shared HTTP session. """
+        return self._setting('HTTP_POOL_MAXSIZE', 10)
+
+    @property
+    def DISCOVERY_CACHE_DIR(self):
+        """ Directory downloaded Google API discovery documents are saved in, private to this user. """
+        return self._setting('DISCOVERY_CACHE_DIR', None)
+
+    @property
+    def DISCOVERY_CACHE_TIMEOUT(self):
+        return self._setting('DISCOVERY_CACHE_TIMEOUT', 60 * 60 * 24)
+
+    @property
+    def DISCOVERY_STATIC_DOCUMENTS(self):
+        """ Use the discovery documents bundled with google-api-python-client before downloading. """
+        return self._setting('DISCOVERY_STATIC_DOCUMENTS', True)
+
+    @property
+    def DRIVE_FOLDER_CACHE_TIMEOUT(self):
+        """ Seconds the Drive folders of an account are kept in memory, see GoogleServiceProvider.resolve_folder. """
+        return self._setting('DRIVE_FOLDER_CACHE_TIMEOUT', 5 * 60)
+
+
+app_settings = AppSettings('SERVICE_INTERACTOR_')
@@ -0,0 +1,288 @@
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import transaction
+
+from allauth.socialaccount.models import SocialApp
+
+
+class ProcessCache:
+    """ Thread-safe dictionary cache shared by every request handled in this process.
+
+    Values are loaded on first access and kept until clear() is called, see signals.py
+    for the handlers that clear each cache when the underlying rows change.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get_or_set(self, key, loader):
+        try:
+            return self._data[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if key in self._data:
+                return self._data[key]
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            # Do not store a value that was loaded before the cache was cleared.
+            if generation == self._generation:
+                self._data[key] = value
+        return value
+
+    async def aget_or_set(self, key, aloader):
+        """ get_or_set for async callers, aloader is awaited instead of called. """
+        try:
+            return self._data[key]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        value = await aloader()
+
+        with self._lock:
+            if generation == self._generation:
+                self._data[key] = value
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data = {}
+
+
+social_apps = ProcessCache()
+
+
+def get_social_app(provider_id):
+    """ SocialApp for the given provider id, queried once per process. """
+    return social_apps.get_or_set(provider_id, lambda: SocialApp.objects.get(provider=provider_id))
+
+
+async def aget_social_app(provider_id):
+    """ Async version of get_social_app. """
+    return await social_apps.aget_or_set(provider_id, lambda: SocialApp.objects.aget(provider=provider_id))
+
+
+def clear_social_apps(**kwargs):
+    social_apps.clear()
+
+
+class VersionCounter:
+    """ Thread-safe per key counters, bumped whenever data cached against the key changes. """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+
+account_scope_versions = VersionCounter()
+
+
+def bump_account_scope_version(instance, **kwargs):
+    account_scope_versions.bump(instance.account_id)
+
+
+class ScopeCatalog:
+    """ Read-through, in memory copy of the Scope table.
+
+    Every process keeps its own copy and reloads it when the version stored in the
+    Django cache no longer matches, which invalidate() changes on Scope save/delete.
+    Requires a cache backend shared between processes for cross-process invalidation.
+    """
+
+    version_key = 'service_interactor:scope_catalog_version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._by_name = {}
+        self._by_access_type = {}
+        self._required = {}
+
+    @property
+    def version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    async def aget_version(self):
+        version = await cache.aget(self.version_key)
+        if version is None:
+            await cache.aadd(self.version_key, uuid.uuid4().hex, None)
+            version = await cache.aget(self.version_key)
+        return version
+
+    def _is_current(self, version):
+        return version is not None and version == self._version
+
+    def _index(self, scopes, version):
+        by_name, by_access_type, required = {}, defaultdict(list), defaultdict(list)
+        for scope in scopes:
+            by_name[(scope.provider, scope.name)] = scope
+            by_access_type[(scope.provider, scope.access_type)].append(scope)
+            if scope.required:
+                required[scope.provider].append(scope)
+
+        self._by_name, self._by_access_type, self._required = by_name, dict(by_access_type), dict(required)
+        self._version = version
+
+    def _ensure_loaded(self):
+        from .models import Scope
+
+        version = self.version
+        if self._is_current(version):
+            return
+
+        with self._lock:
+            if not self._is_current(version):
+                self._index(Scope.objects.all(), version)
+
+    async def aensure_loaded(self):
+        """ Loads the catalog with the async ORM so later lookups from async code never query. """
+        from .models import Scope
+
+        version = await self.aget_version()
+        if self._is_current(version):
+            return
+
+        scopes = [scope async for scope in Scope.objects.all()]
+        with self._lock:
+            self._index(scopes, version)
+
+    def get(self, provider, name):
+        """ Scope with the given name for the provider, None when it does not exist. """
+        self._ensure_loaded()
+        return self._by_name.get((provider, name))
+
+    def filter(self, provider, access_type=None, required=None):
+        """ List of the providers Scope objects matching the supplied access_type and required flag. """
+        self._ensure_loaded()
+        if access_type is not None:
+            scopes = self._by_access_type.get((provider, access_type), [])
+        elif required:
+            return list(self._required.get(provider, []))
+        else:
+            scopes = [s for (p, _), s in self._by_name.items() if p == provider]
+        if required is not None:
+            scopes = [s for s in scopes if s.required == required]
+        return list(scopes)
+
+    def access_types(self, provider, load=True):
+        """ Set of access_type values the provider has scopes for.
+
+        Async code passes load=False after awaiting aensure_loaded, the version check is a
+        synchronous cache lookup that must not run on the event loop.
+        """
+        if load:
+            self._ensure_loaded()
+        return {access_type for (p, access_type) in self._by_access_type if p == provider}
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+        with self._lock:
+            self._version = None
+
+
+scope_catalog = ScopeCatalog()
+
+
+def invalidate_scope_catalog(**kwargs):
+    # After the commit, otherwise another thread could reload the old rows under the new version
+    transaction.on_commit(scope_catalog.invalidate)
+
+
+class DriveFolderIndex:
+    """ Folders of one Drive account indexed by parent id and name, built from a single listing.
+
+    Safe to share between threads, readers get copies taken under the index lock.
+    """
+
+    def __init__(self, root_id, folders):
+        self.root_id = root_id
+        self.folders = {}
+        self._children = defaultdict(dict)
+        self._lock = threading.Lock()
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder):
+        with self._lock:
+            self.folders[folder['id']] = folder
+            for parent_id in folder.get('parents', []):
+                self._children[parent_id].setdefault(folder['name'], []).append(folder)
+
+    def all(self):
+        """ Every indexed folder. """
+        with self._lock:
+            return list(self.folders.values())
+
+    def child(self, parent_id, name):
+        """ First folder called name directly inside parent_id, None when it is not indexed. """
+        with self._lock:
+            folders = self._children.get(parent_id, {}).get(name)
+            return folders[0] if folders else None
+
+    def children(self, parent_id):
+        with self._lock:
+            return [folder for folders in self._children.get(parent_id, {}).values() for folder in folders]
+
+
+class DriveFolderCache:
+    """ DriveFolderIndex per account, reloaded once older than the timeout.
+
+    lock(account_id) is held while folders are created so that concurrent jobs
+    in this process create each missing folder once. It is a threading lock, jobs in
+    other processes or on other hosts are not serialised and can still create duplicates.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, account_id):
+        with self._lock:
+            return self._locks.setdefault(account_id, threading.RLock())
+
+    def get(self, account_id, loader, timeout):
+        entry = self._entries.get(account_id)
+        if entry and time.monotonic() - entry[1] < timeout:
+            return entry[0]
+
+        with self.lock(account_id):
+            entry = self._entries.get(account_id)
+            if entry and time.monotonic() - entry[1] < timeout:
+                return entry[0]
+            index = loader()
+            self._entries[account_id] = (index, time.monotonic())
+            return index
+
+    def clear(self, account_id=None):
+        with self._lock:
+            if account_id is None:
+                self._entries = {}
+            else:
+                self._entries.pop(account_id, None)
+
+
+drive_folders = DriveFolderCache()
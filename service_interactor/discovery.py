@@ -0,0 +1,118 @@
+import json
+import logging
+import os
+import stat
+import threading
+import time
+
+from googleapiclient import discovery
+
+from .app_settings import app_settings
+from .caches import ProcessCache
+from .transport import get_http_session
+
+
+log = logging.getLogger('service_interactor.discovery')
+
+_documents = ProcessCache()
+_parsed = threading.local()
+
+
+def _is_private(path):
+    """ True when path belongs to the current user and nobody else can write to it. """
+    if not hasattr(os, 'getuid'):
+        return True
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _cache_path(service_name, version):
+    """ Path of the saved document, None when the disk cache is disabled or not private to this user.
+
+    A document planted by another user could point every request, and its token, at their host.
+    """
+    directory = app_settings.DISCOVERY_CACHE_DIR
+    if not directory:
+        return None
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not _is_private(directory):
+        log.warning('Ignoring discovery cache %s, it is not private to this user', directory)
+        return None
+    return os.path.join(directory, f'{service_name}.{version}.json')
+
+
+def _read_disk_cache(path):
+    if not path or not os.path.exists(path):
+        return None
+    if not _is_private(path):
+        log.warning('Ignoring discovery document %s, it is not private to this user', path)
+        return None
+    if time.time() - os.path.getmtime(path) > app_settings.DISCOVERY_CACHE_TIMEOUT:
+        return None
+    with open(path, 'r', encoding='utf-8') as fo:
+        return fo.read()
+
+
+def _write_disk_cache(path, content):
+    if not path:
+        return
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as fo:
+        fo.write(content)
+    os.replace(tmp_path, path)
+
+
+def _get_static_document(service_name, version):
+    if not app_settings.DISCOVERY_STATIC_DOCUMENTS:
+        return None
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:  # google-api-python-client < 2.0
+        return None
+    return get_static_doc(service_name, version)
+
+
+def _fetch_document(service_name, version):
+    session = get_http_session()
+    response = None
+    for uri in (discovery.DISCOVERY_URI, discovery.V2_DISCOVERY_URI):
+        response = session.get(uri.format(api=service_name, apiVersion=version))
+        if response.ok:
+            return response.text
+    response.raise_for_status()
+
+
+def _load_document(service_name, version):
+    content = _get_static_document(service_name, version)
+    if content:
+        return content
+
+    path = _cache_path(service_name, version)
+    content = _read_disk_cache(path)
+    if not content:
+        content = _fetch_document(service_name, version)
+        _write_disk_cache(path, content)
+    return content
+
+
+def get_discovery_document(service_name, version):
+    """ Parsed discovery document for the Google API service name and version.
+
+    The JSON is read once per process, from the documents bundled with google-api-python-client,
+    the disk cache when DISCOVERY_CACHE_DIR is set or, failing those, downloaded and saved to it.
+    Each thread parses it once since googleapiclient fills in the document while building
+    services.
+    """
+    key = (service_name, version)
+    documents = getattr(_parsed, 'documents', None)
+    if documents is None:
+        documents = _parsed.documents = {}
+    if key not in documents:
+        documents[key] = json.loads(_documents.get_or_set(key, lambda: _load_document(service_name, version)))
+    return documents[key]
+
+
+def clear_discovery_documents():
+    global _parsed
+    _documents.clear()
+    _parsed = threading.local()
@@ -0,0 +1,189 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+
+from googleapiclient.errors import HttpError
+from httplib2 import ServerNotFoundError
+
+from .utils import run_in_worker
+
+
+log = logging.getLogger('service_interactor.downloads')
+
+
+# Totals across every file of a DriveDownloadManager run, passed to its progress callback.
+DownloadProgress = namedtuple('DownloadProgress', [
+    'files_done', 'files_failed', 'files_total', 'bytes_done', 'bytes_total',
+])
+
+# Outcome of a single file, error is None when the download succeeded.
+DownloadResult = namedtuple('DownloadResult', ['file_id', 'path', 'attempts', 'error'])
+
+# 403 reasons Drive uses for rate limiting, other 403s are permanent.
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+def is_transient_error(error):
+    """ Whether retrying the request that raised error can succeed: rate limits, server and connection errors. """
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        if status == 429 or status >= 500:
+            return True
+        if status == 403:
+            try:
+                errors = json.loads(error.content).get('error', {}).get('errors', [])
+            except (ValueError, AttributeError):
+                return False
+            return any(e.get('reason') in RATE_LIMIT_REASONS for e in errors)
+        return False
+    return isinstance(error, (ConnectionError, TimeoutError, HTTPException, ServerNotFoundError))
+
+
+class BandwidthLimiter:
+    """ Thread-safe limit on the bytes per second shared by every download of a manager. """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def consume(self, size):
+        """ Blocks the calling thread until size bytes fit within the limit. """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_free)
+            self._next_free = start + size / self.bytes_per_second
+            delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DriveDownloadManager:
+    """ Downloads many Drive files at the same time, each one streamed to its own file.
+
+    Files are started largest first, when their size is known, so the total time approaches
+    that of the largest file. A failed download is retried from where it stopped, see
+    GoogleServiceProvider.download_file resume. Only transient errors are retried, see is_transient_error.
+
+    Args:
+        provider: GoogleServiceProvider to download with
+        directory: folder to save into, a temporary folder is created when not supplied
+        max_workers: maximum files downloaded at the same time
+        retries: attempts made per file after the first one fails
+        max_bytes_per_second: bandwidth shared by every download, unlimited when not supplied
+        chunk_size: bytes requested per range request, see GoogleServiceProvider.download_file
+        progress: callable receiving a DownloadProgress after every chunk and finished file,
+            called from the worker threads
+    """
+
+    retry_delay = 2
+
+    def __init__(self, provider, directory=None, max_workers=4, retries=3, max_bytes_per_second=None,
+                 chunk_size=None, progress=None):
+        self.provider = provider
+        self.directory = directory or tempfile.mkdtemp(prefix='service_interactor_')
+        self.max_workers = max_workers
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.limiter = BandwidthLimiter(max_bytes_per_second) if max_bytes_per_second else None
+
+        self._lock = threading.Lock()
+        self._downloaded = {}
+        self._sizes = {}
+        self._done = 0
+        self._failed = 0
+
+    def _report(self):
+        if not self.progress:
+            return
+        with self._lock:
+            report = DownloadProgress(
+                files_done=self._done,
+                files_failed=self._failed,
+                files_total=len(self._sizes),
+                bytes_done=sum(self._downloaded.values()),
+                bytes_total=sum(size or 0 for size in self._sizes.values()),
+            )
+        self.progress(report)
+
+    def _chunk_received(self, file_id, downloaded, total):
+        with self._lock:
+            received = downloaded - self._downloaded.get(file_id, 0)
+            self._downloaded[file_id] = downloaded
+            if total is not None:
+                self._sizes[file_id] = total
+        if self.limiter and received > 0:
+            self.limiter.consume(received)
+        self._report()
+
+    def _download(self, file_id, path):
+        attempts = 0
+        try:
+            while True:
+                attempts += 1
+                try:
+                    self.provider.download_file(
+                        file_id,
+                        path,
+                        chunk_size=self.chunk_size,
+                        progress=lambda downloaded, total: self._chunk_received(file_id, downloaded, total),
+                        resume=attempts > 1,
+                    )
+                except Exception as e:  # noqa
+                    if attempts > self.retries or not is_transient_error(e):
+                        log.exception('Failed to download %s after %s attempts', file_id, attempts)
+                        with self._lock:
+                            self._failed += 1
+                        return DownloadResult(file_id, path, attempts, e)
+                    log.warning('Retrying download of %s: %s', file_id, e)
+                    time.sleep(self.retry_delay * 2 ** (attempts - 1))
+                else:
+                    with self._lock:
+                        self._done += 1
+                    return DownloadResult(file_id, path, attempts, None)
+        finally:
+            self._report()
+
+    def _destinations(self, files):
+        """ Yields (file_id, path, size) for file ids or get_files dicts, giving every file its own path. """
+        used, seen = set(), set()
+        for file in files:
+            if isinstance(file, str):
+                file = {'id': file}
+            if file['id'] in seen:
+                continue
+            seen.add(file['id'])
+            name = os.path.basename(file.get('name') or '') or file['id']
+            if name in used:
+                name = f'{file["id"]}-{name}'
+            used.add(name)
+            # Drive returns size as a string of bytes, get_takeout_files replaces it with megabytes
+            size = file.get('size')
+            size = int(size) if isinstance(size, str) and size.isdigit() else None
+            yield file['id'], os.path.join(self.directory, name), size
+
+    def download(self, files):
+        """ Downloads every file, returns a dict of file id to DownloadResult.
+
+        Args:
+            files: iterable of file ids or file dicts as yielded by GoogleServiceProvider.get_files
+        """
+        destinations = sorted(self._destinations(files), key=lambda item: item[2] or 0, reverse=True)
+        for file_id, path, size in destinations:
+            self._sizes[file_id] = size
+
+        # Built once here, the worker threads then share it.
+        self.provider.drive_service
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(run_in_worker, self._download, file_id, path) for file_id, path, _ in destinations
+            ]
+            return {result.file_id: result for result in (future.result() for future in futures)}
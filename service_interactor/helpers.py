@@ -1,8 +1,16 @@
 import base64
 import binascii
 import email
+import email.message
+import email.policy
+import email.utils
 import mimetypes
 import os
+import tempfile
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
@@ -12,14 +20,95 @@ from email.mime.base import MIMEBase
 from django.utils.functional import cached_property
 
 from googleapiclient import errors
+from googleapiclient.http import MediaIoBaseUpload
+
+from .downloads import is_transient_error
+
+
+# Bytes of attachment data decoded and written at a time
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+
+# Outgoing messages are kept in memory up to this size, then moved to a temporary file
+MESSAGE_SPOOL_SIZE = 5 * 1024 * 1024
+
+# Messages over this size are sent with a resumable upload in UPLOAD_CHUNK_SIZE requests
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+class GmailHistoryExpired(Exception):
+    """ The start history id is no longer available, the mailbox needs a full sync. """
+
+
+class GmailChange(namedtuple('GmailChange', ['action', 'message_id', 'thread_id', 'label_ids', 'full_sync'])):
+    """ A message change from the mailbox history, full_sync is True for messages listed by a full resync. """
+
+    ADDED = 'added'
+    DELETED = 'deleted'
+    LABELS_ADDED = 'labels_added'
+    LABELS_REMOVED = 'labels_removed'
+
+    HISTORY_ACTIONS = {
+        'messagesAdded': ADDED,
+        'messagesDeleted': DELETED,
+        'labelsAdded': LABELS_ADDED,
+        'labelsRemoved': LABELS_REMOVED,
+    }
+
+    def __new__(cls, action, message_id, thread_id=None, label_ids=None, full_sync=False):
+        return super().__new__(cls, action, message_id, thread_id, label_ids or [], full_sync)
+
+
+class MessageAttachment(namedtuple('MessageAttachment', ['filename', 'source'])):
+    """ Attachment sent under filename, source is a path or a binary file object, see GmailHelper.send_message. """
 
 
 class GmailHelper:
 
+    # Google allows 100 calls per batch request, Gmail rate limits batches of more than 50
+    max_batch_size = 50
+
+    # Gets of a batch that failed with a transient error are sent again in a follow-up batch
+    batch_retries = 5
+    batch_retry_delay = 1
+
+    # batchModify and batchDelete accept up to 1000 message ids per call
+    max_bulk_size = 1000
+
     def __init__(self, service):
         self.service = service
 
-    def messages(self, max_results=None, page_token=None, q=None, label_ids=None, include_spam_trash=None):
+    def messages(self, max_results=None, page_token=None, q=None, label_ids=None, include_spam_trash=None,
+                 batch_size=None, format=None, fields=None, metadata_headers=None):
+        """ Yields a GmailMessage for every message matching the filters, in list order.
+
+        References:
+            https://developers.google.com/gmail/api/reference/rest/v1/users.messages/list
+            https://developers.google.com/gmail/api/guides/batch
+
+        Args:
+            batch_size: fetch messages through batch requests of this many gets, at most max_batch_size
+            format: message format to fetch, i.e. 'metadata' when bodies are not needed
+            fields: partial response field mask for each message, must include id
+            metadata_headers: list of headers to return when format is 'metadata'
+        """
+        get_kwargs = GmailMessage.get_kwargs(format=format, fields=fields, metadata_headers=metadata_headers)
+        if batch_size:
+            batch_size = min(batch_size, self.max_batch_size)
+
+        for items in self.message_pages(max_results, page_token, q, label_ids, include_spam_trash):
+
+            message_ids = [item['id'] for item in items]
+
+            if batch_size:
+                for start in range(0, len(message_ids), batch_size):
+                    yield from self._batch_load(message_ids[start:start + batch_size], get_kwargs)
+            else:
+                for message_id in message_ids:
+                    yield GmailMessage.load(self.service, message_id, **get_kwargs)
+
+    def message_pages(self, max_results=None, page_token=None, q=None, label_ids=None, include_spam_trash=None):
+        """ Yields each page of users.messages.list as a list of {'id': ..., 'threadId': ...} dicts. """
         vals = {
             'userId': 'me',
         }
@@ -40,12 +129,172 @@ class GmailHelper:
 
             vals['pageToken'] = data.get('nextPageToken')
 
-            for item in data.get('messages', []):
-                yield GmailMessage.load(self.service, item['id'])
+            yield data.get('messages', [])
+
+            if not vals['pageToken']:
+                break
+
+    def history_pages(self, start_history_id, history_types=None, label_id=None):
+        """ Yields each page of mailbox history recorded after start_history_id.
 
+        References:
+            https://developers.google.com/gmail/api/reference/rest/v1/users.history/list
+
+        Raises:
+            GmailHistoryExpired: start_history_id is too old, a full sync is required
+        """
+        vals = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+        }
+        if history_types:
+            vals['historyTypes'] = history_types
+        if label_id:
+            vals['labelId'] = label_id
+
+        while True:
+            try:
+                data = self.service.users().history().list(**vals).execute()
+            except errors.HttpError as error:
+                if error.resp.status == 404:
+                    raise GmailHistoryExpired(start_history_id) from error
+                raise
+
+            yield data
+
+            vals['pageToken'] = data.get('nextPageToken')
             if not vals['pageToken']:
                 break
 
+    def changes(self, start_history_id, history_types=None, label_id=None):
+        """ Yields a GmailChange for every message added, deleted or relabeled after start_history_id.
+
+        Returns:
+            The mailbox historyId to continue from next time, as the generators return value
+        """
+        history_id = start_history_id
+        for page in self.history_pages(start_history_id, history_types, label_id):
+            history_id = page.get('historyId', history_id)
+            for record in page.get('history', []):
+                for key, action in GmailChange.HISTORY_ACTIONS.items():
+                    for item in record.get(key, []):
+                        message = item['message']
+                        yield GmailChange(
+                            action=action,
+                            message_id=message['id'],
+                            thread_id=message.get('threadId'),
+                            label_ids=item.get('labelIds', message.get('labelIds')),
+                        )
+        return history_id
+
+    def profile(self):
+        return self.service.users().getProfile(userId='me').execute()
+
+    def _batch_load(self, message_ids, get_kwargs):
+        """ Yields the messages of one batch, gets failing with a transient error are retried with backoff. """
+        responses = {}
+
+        def callback(request_id, response, exception):
+            responses[request_id] = exception or response
+
+        pending = message_ids
+        for attempt in range(self.batch_retries + 1):
+            if attempt:
+                time.sleep(self.batch_retry_delay * 2 ** (attempt - 1))
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(
+                    self.service.users().messages().get(userId='me', id=message_id, **get_kwargs),
+                    request_id=message_id,
+                )
+            batch.execute()
+
+            pending = [message_id for message_id in pending if is_transient_error(responses[message_id])]
+            if not pending:
+                break
+
+        for message_id in message_ids:
+            response = responses[message_id]
+            if isinstance(response, Exception):
+                raise response
+            yield GmailMessage(self.service, response, format=get_kwargs.get('format'))
+
+    @staticmethod
+    def _message_ids(messages):
+        message_ids = []
+        for message in messages:
+            if isinstance(message, GmailMessage):
+                message = message.id
+            elif isinstance(message, dict):
+                message = message['id']
+            message_ids.append(message)
+        return message_ids
+
+    def _bulk_request(self, method, messages, body=None, chunk_size=None):
+        chunk_size = min(chunk_size or self.max_bulk_size, self.max_bulk_size)
+        message_ids = self._message_ids(messages)
+
+        results = []
+        for start in range(0, len(message_ids), chunk_size):
+            chunk = message_ids[start:start + chunk_size]
+            result = {'message_ids': chunk, 'response': None, 'error': None}
+            try:
+                result['response'] = method(userId='me', body=dict(body or {}, ids=chunk)).execute()
+            except errors.HttpError as error:
+                result['error'] = error
+            results.append(result)
+        return results
+
+    def batch_modify(self, messages, add_label_ids=None, remove_label_ids=None, chunk_size=None):
+        """ Adds and removes labels on many messages, max_bulk_size messages per call.
+
+        References:
+            https://developers.google.com/gmail/api/reference/rest/v1/users.messages/batchModify
+
+        Args:
+            messages: message ids, GmailMessage objects or message dicts
+            add_label_ids: label ID or list of label ID's to add
+            remove_label_ids: label ID or list of label ID's to remove
+            chunk_size: messages per call, at most max_bulk_size
+
+        Returns:
+            list of dicts with message_ids, response and error (HttpError or None) per chunk
+        """
+        return self._bulk_request(self.service.users().messages().batchModify, messages, body={
+            'addLabelIds': self._label_ids(add_label_ids),
+            'removeLabelIds': self._label_ids(remove_label_ids),
+        }, chunk_size=chunk_size)
+
+    @staticmethod
+    def _label_ids(label_ids):
+        """ List of label ids from a single id, an iterable of ids or None. """
+        if isinstance(label_ids, str):
+            return [label_ids]
+        return list(label_ids or [])
+
+    def batch_label_manager(self, messages, label_ids=None, remove_ids=None, remove_from_inbox=True,
+                            mark_as_read=False, chunk_size=None):
+        """ GmailMessage.label_manager for many messages, see batch_modify """
+        remove_ids = self._label_ids(remove_ids)
+        if mark_as_read:
+            remove_ids.append('UNREAD')
+        if remove_from_inbox:
+            remove_ids.append('INBOX')
+        return self.batch_modify(messages, add_label_ids=label_ids, remove_label_ids=remove_ids,
+                                 chunk_size=chunk_size)
+
+    def batch_delete(self, messages, chunk_size=None):
+        """ Permanently deletes many messages, they are not moved to the trash.
+
+        References:
+            https://developers.google.com/gmail/api/reference/rest/v1/users.messages/batchDelete
+
+        Returns:
+            list of dicts with message_ids, response and error (HttpError or None) per chunk
+        """
+        return self._bulk_request(self.service.users().messages().batchDelete, messages, chunk_size=chunk_size)
+
     def labels(self):
         return self.service.users().labels().list(userId='me').execute().get('labels', [])
 
@@ -54,7 +303,50 @@ class GmailHelper:
             'name': name
         }).execute()
 
-    def send_message(self, to, subject, body, attachments=None, body_type='plain', _from=None, send=True):
+    @staticmethod
+    def _open_attachment(attachment):
+        """ Returns (filename, binary file object, whether the caller must close it) for an attachment.
+
+        An attachment is a path, a binary file object or a MessageAttachment.
+        """
+        if isinstance(attachment, MessageAttachment):
+            filename, source = attachment
+            if hasattr(source, 'read'):
+                return filename, source, False
+            return filename, open(source, 'rb'), True
+        if hasattr(attachment, 'read'):
+            return os.path.basename(getattr(attachment, 'name', None) or 'attachment'), attachment, False
+        return os.path.basename(attachment), open(attachment, 'rb'), True
+
+    @staticmethod
+    def _attachment_content_type(filename):
+        content_type, encoding = mimetypes.guess_type(filename)
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+        return content_type
+
+    def send_message(self, to, subject, body, attachments=None, body_type='plain', _from=None, send=True,
+                     thread_id=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """ Sends an email, or returns it as a MIMEMultipart when send is False.
+
+        When sending, the message is written to a spooled temporary file with the attachments
+        streamed into it and uploaded through the media upload endpoint, resumable once it is
+        larger than RESUMABLE_UPLOAD_THRESHOLD.
+
+        Args:
+            attachments: list of paths, binary file objects or MessageAttachment
+            thread_id: Gmail thread to add the message to
+            chunk_size: bytes per resumable upload request
+        """
+        if not attachments:
+            attachments = []
+        if isinstance(attachments, MessageAttachment) or not isinstance(attachments, (list, tuple, set)):
+            attachments = [attachments]
+
+        if send:
+            with self.build_message_file(to, subject, body, attachments, body_type, _from) as fo:
+                return self._upload_message(fo, thread_id=thread_id, chunk_size=chunk_size)
+
         message = MIMEMultipart()
         message['to'] = to
         message['subject'] = subject
@@ -65,19 +357,12 @@ class GmailHelper:
         msg = MIMEText(body, body_type)
         message.attach(msg)
 
-        if not attachments:
-            attachments = []
-        if not isinstance(attachments, (list, tuple, set)):
-            attachments = [attachments]
-
         for att in attachments:
 
-            content_type, encoding = mimetypes.guess_type(att)
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-            main_type, sub_type = content_type.split('/', 1)
+            filename, fo, close = self._open_attachment(att)
+            main_type, sub_type = self._attachment_content_type(filename).split('/', 1)
 
-            with open(att, 'rb') as fo:
+            try:
                 if main_type == 'text':
                     msg = MIMEText(fo.read(), _subtype=sub_type)
                 elif main_type == 'image':
@@ -87,15 +372,97 @@ class GmailHelper:
                 else:
                     msg = MIMEBase(main_type, sub_type)
                     msg.set_payload(fo.read())
+            finally:
+                if close:
+                    fo.close()
 
             if msg:
-                msg.add_header('Content-Disposition', 'attachment', filename=os.path.basename(att))
+                msg.add_header('Content-Disposition', 'attachment', filename=filename)
                 message.attach(msg)
 
-        if send:
-            return self._send_message(message)
         return message
 
+    def build_message_file(self, to, subject, body, attachments=None, body_type='plain', _from=None):
+        """ Writes a multipart/mixed message to a spooled temporary file without holding attachments in memory.
+
+        Returns:
+            The temporary file, positioned at its start
+        """
+        policy = email.policy.SMTP
+        boundary = f'==============={uuid.uuid4().hex}=='
+
+        fo = tempfile.SpooledTemporaryFile(max_size=MESSAGE_SPOOL_SIZE)
+
+        def write_headers(headers):
+            for name, value in headers:
+                fo.write(policy.fold_binary(name, policy.header_factory(name, value)))
+            fo.write(b'\r\n')
+
+        headers = [('To', to)]
+        if _from:
+            headers.append(('From', _from))
+        headers += [
+            ('Subject', subject),
+            ('MIME-Version', '1.0'),
+            ('Content-Type', f'multipart/mixed; boundary="{boundary}"'),
+        ]
+        write_headers(headers)
+
+        fo.write(f'--{boundary}\r\n'.encode())
+        fo.write(MIMEText(body, body_type).as_bytes(policy=policy))
+
+        for att in attachments or []:
+            filename, source, close = self._open_attachment(att)
+            try:
+                fo.write(f'\r\n--{boundary}\r\n'.encode())
+                write_headers([
+                    ('Content-Type', self._attachment_content_type(filename)),
+                    ('Content-Transfer-Encoding', 'base64'),
+                    ('Content-Disposition', f'attachment; filename="{email.utils.quote(filename)}"'),
+                ])
+                # Only whole 57 byte groups are encoded, to full 76 character base64 lines, until the
+                # end so short reads never leave padding in the middle of the body
+                pending = b''
+                while True:
+                    data = source.read(57 * 1024)
+                    if not data:
+                        break
+                    pending += data
+                    size = len(pending) - len(pending) % 57
+                    if size:
+                        fo.write(base64.encodebytes(pending[:size]).replace(b'\n', b'\r\n'))
+                        pending = pending[size:]
+                if pending:
+                    fo.write(base64.encodebytes(pending).replace(b'\n', b'\r\n'))
+            finally:
+                if close:
+                    source.close()
+
+        fo.write(f'\r\n--{boundary}--\r\n'.encode())
+        fo.seek(0)
+        return fo
+
+    def _upload_message(self, fo, thread_id=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        fo.seek(0, os.SEEK_END)
+        size = fo.tell()
+        fo.seek(0)
+
+        resumable = size > RESUMABLE_UPLOAD_THRESHOLD
+        media = MediaIoBaseUpload(fo, mimetype='message/rfc822', chunksize=chunk_size, resumable=resumable)
+        request = self.service.users().messages().send(
+            userId='me',
+            body={'threadId': thread_id} if thread_id else {},
+            media_body=media,
+        )
+
+        if not resumable:
+            return request.execute()
+
+        response = None
+        while response is None:
+            _, response = request.next_chunk()
+        return response
+
     def _send_message(self, message):
         msg_as_bytes = message.as_bytes()
         data = {'raw': base64.urlsafe_b64encode(msg_as_bytes).decode()}
@@ -104,30 +471,64 @@ class GmailHelper:
 
 class GmailMessage:
 
-    def __init__(self, service, message):
+    # Message formats accepted by load(), fetch only what is needed:
+    #   metadata: ids, labels and headers
+    #   full: headers and the parsed payload, attachments over a size limit need another call each
+    #   raw: the whole message, headers, body and attachments are parsed locally from it
+    FORMAT_METADATA = 'metadata'
+    FORMAT_FULL = 'full'
+    FORMAT_RAW = 'raw'
+
+    def __init__(self, service, message, format=None):
         self.service = service
         self._message = message
+        self.format = format or self.FORMAT_FULL
         self.id = message['id']
-        self.threadId = message['threadId']
+        self.threadId = message.get('threadId')
         self._attachments = []
         self._body = None
 
     def __str__(self):
         return self.subject
 
+    @staticmethod
+    def get_kwargs(format=None, fields=None, metadata_headers=None):
+        """ Keyword arguments for users.messages.get from the load options. """
+        kwargs = {}
+        if format:
+            kwargs['format'] = format
+        if fields:
+            kwargs['fields'] = fields
+        if metadata_headers:
+            kwargs['metadataHeaders'] = metadata_headers
+        return kwargs
+
     @classmethod
-    def load(cls, service, message_id):
+    def load(cls, service, message_id, format=None, fields=None, metadata_headers=None):
 
         if isinstance(message_id, dict):
             message_id = message_id['id']
 
-        message = service.users().messages().get(userId='me', id=message_id).execute()
-        return cls(service, message)
+        message = service.users().messages().get(
+            userId='me', id=message_id, **cls.get_kwargs(format, fields, metadata_headers)
+        ).execute()
+        return cls(service, message, format=format)
 
     def get_raw_message(self):
+        if 'raw' in self._message:
+            return base64.urlsafe_b64decode(self._message['raw'].encode('utf-8'))
         message = self.service.users().messages().get(userId='me', id=self.id, format='raw').execute()
         return base64.urlsafe_b64decode(message['raw'].encode('utf-8'))
 
+    @cached_property
+    def mime(self):
+        """ The message parsed as an email.message.EmailMessage.
+
+        Parsed once, from the fetched raw data when loaded with format='raw', otherwise the
+        raw message is fetched first.
+        """
+        return email.message_from_bytes(self.get_raw_message(), policy=email.policy.default)
+
     @cached_property
     def account_email_address(self):
         return self.service.users().getProfile(userId='me').execute()['emailAddress']
@@ -135,6 +536,10 @@ class GmailMessage:
     @cached_property
     def headers(self):
         headers = {}
+        if 'payload' not in self._message:
+            for name, value in self.mime.items():
+                headers[name] = str(value)
+            return headers
         for header in self._message['payload']['headers']:
             headers[header['name']] = header['value']
         return headers
@@ -158,20 +563,62 @@ class GmailMessage:
             return _from[first_position:second_position]
         return _from[first_position:]
 
+    def _walk_payload(self, part=None):
+        part = part or self._message['payload']
+        yield part
+        for sub_part in part.get('parts', []):
+            yield from self._walk_payload(sub_part)
+
+    def _payload_body(self, body_load_order):
+        """ Body text from a message fetched in full format, None when it needs the raw message. """
+        for subtype in body_load_order:
+            for part in self._walk_payload():
+                if part.get('mimeType') != f'text/{subtype}' or part.get('filename'):
+                    continue
+                data = part.get('body', {}).get('data')
+                if not data:
+                    return None
+                content_type = email.message.Message()
+                for header in part.get('headers', []):
+                    if header['name'].lower() == 'content-type':
+                        content_type['Content-Type'] = header['value']
+                charset = content_type.get_content_charset() or 'utf-8'
+                return base64.urlsafe_b64decode(data.encode('utf-8')).decode(charset, errors='replace')
+        return None
+
     def body(self, body_load_order=None):
+        body_load_order = body_load_order or ('plain', 'html')
         if not self._body:
-            raw_message = self.get_raw_message()
-            email_data = email.message_from_bytes(raw_message, policy=email.policy.default)
-            self._body = email_data.get_body(preferencelist=body_load_order or ('plain', 'html'))
-            if self._body:
-                self._body = self._body.get_content()
+            if self.format == self.FORMAT_FULL and 'payload' in self._message:
+                self._body = self._payload_body(body_load_order)
+            if not self._body:
+                self._body = self.mime.get_body(preferencelist=body_load_order)
+                if self._body:
+                    self._body = self._body.get_content()
         return self._body
 
+    def _mime_attachments(self):
+        """ Parts of the raw message with a filename, at any depth, as _walk_payload finds them in full format. """
+        for part in self.mime.walk():
+            if part.is_multipart():
+                continue
+            if part.get_filename() or part.is_attachment():
+                yield part
+
     def attachments(self, encoding='utf-8'):
         if self._attachments:
             return self._attachments
-        for part in self._message['payload']['parts']:
-            if part['filename']:
+
+        if self.format != self.FORMAT_FULL or 'payload' not in self._message:
+            for part in self._mime_attachments():
+                self._attachments.append({
+                    'name': part.get_filename(),
+                    'data': part.get_payload(decode=True),
+                })
+            return self._attachments
+
+        for part in self._walk_payload():
+            if part.get('filename'):
                 data = part.get('body', {}).get('data')
                 if not data:
                     try:
@@ -200,6 +647,63 @@ class GmailMessage:
 
         return self._attachments
 
+    def iter_attachments(self):
+        """ Yields a GmailAttachment for every attachment without downloading any of them. """
+        if self.format != self.FORMAT_FULL or 'payload' not in self._message:
+            for part in self._mime_attachments():
+                yield GmailAttachment(
+                    message=self,
+                    filename=part.get_filename(),
+                    mime_type=part.get_content_type(),
+                    mime_part=part,
+                )
+            return
+
+        for part in self._walk_payload():
+            if part.get('filename'):
+                body = part.get('body', {})
+                yield GmailAttachment(
+                    message=self,
+                    filename=part['filename'],
+                    mime_type=part.get('mimeType'),
+                    size=body.get('size'),
+                    attachment_id=body.get('attachmentId'),
+                    data=body.get('data'),
+                )
+
+    def download_attachments(self, directory=None, max_workers=1, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """ Streams every attachment to its own file.
+
+        Args:
+            directory: folder to save into, temporary files are created when not supplied, an
+                attachment whose name is already taken is prefixed with its position
+            max_workers: download this many attachments at the same time, requires a thread-safe
+                service such as the ones built by GoogleServiceProvider.resource
+            chunk_size: bytes decoded and written at a time
+
+        Returns:
+            list of (GmailAttachment, path) in message order
+        """
+        def save(attachment, destination):
+            return attachment, attachment.save(destination, chunk_size=chunk_size)
+
+        attachments = list(self.iter_attachments())
+        destinations = [None] * len(attachments)
+        if directory:
+            # Attachments often share a name, such as image.png, give every one its own path
+            used = set()
+            for index, attachment in enumerate(attachments):
+                name = os.path.basename(attachment.filename or '') or 'attachment'
+                while name in used:
+                    name = f'{index}-{name}'
+                used.add(name)
+                destinations[index] = os.path.join(directory, name)
+
+        if max_workers <= 1:
+            return [save(attachment, destination) for attachment, destination in zip(attachments, destinations)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(save, attachments, destinations))
+
     def labels(self):
         return self._message['labelIds']
 
@@ -256,6 +760,79 @@ class GmailMessage:
         return self.service.users().messages().trash(userId='me', id=self._message['id']).execute()
 
 
+class GmailAttachment:
+    """ A single attachment of a GmailMessage, its data is only fetched by save(). """
+
+    def __init__(self, message, filename, mime_type=None, size=None, attachment_id=None, data=None, mime_part=None):
+        self.message = message
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size = size
+        self.attachment_id = attachment_id
+        self._data = data
+        self._mime_part = mime_part
+
+    def __str__(self):
+        return self.filename
+
+    def _fetch_data(self):
+        if self._data:
+            return self._data
+        return self.message.service.users().messages().attachments().get(
+            userId='me',
+            messageId=self.message.id,
+            id=self.attachment_id,
+        ).execute()['data']
+
+    def write_to(self, sink, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """ Writes the decoded attachment to a writable binary file object in chunks.
+
+        Returns:
+            Number of bytes written
+        """
+        if self._mime_part is not None:
+            data = self._mime_part.get_payload(decode=True) or b''
+            for start in range(0, len(data), chunk_size):
+                sink.write(data[start:start + chunk_size])
+            return len(data)
+
+        data = self._fetch_data()
+        # Decode whole 4 character groups of base64 so each chunk stands on its own
+        step = max(chunk_size // 3, 1) * 4
+        written = 0
+        for start in range(0, len(data), step):
+            encoded = data[start:start + step]
+            encoded += '=' * (-len(encoded) % 4)
+            decoded = base64.urlsafe_b64decode(encoded.encode('ascii'))
+            sink.write(decoded)
+            written += len(decoded)
+        return written
+
+    def save(self, destination=None, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """ Streams the attachment to destination.
+
+        Args:
+            destination: path or writable binary file object, a temporary file is created when None
+            chunk_size: bytes decoded and written at a time
+
+        Returns:
+            The path written to, or destination itself when it is a file object
+        """
+        if hasattr(destination, 'write'):
+            self.write_to(destination, chunk_size=chunk_size)
+            return destination
+
+        if destination is None:
+            suffix = os.path.splitext(self.filename or '')[1]
+            with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as fo:
+                self.write_to(fo, chunk_size=chunk_size)
+            return fo.name
+
+        with open(destination, 'wb') as fo:
+            self.write_to(fo, chunk_size=chunk_size)
+        return destination
+
+
 class BaseYoutubePlaylistClass:
 
     def __getitem__(self, item):
@@ -0,0 +1,176 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Prefetch
+
+from allauth.socialaccount.models import SocialAccount, SocialToken
+
+from .app_settings import app_settings
+from .caches import aget_social_app, scope_catalog
+from .models import SERVICE_PROVIDER_CLASSES, Service, UserProviderScope
+
+
+def load_services(services):
+    """ Loads Service objects with everything their ServiceProvider needs in a fixed number of queries.
+
+    One query each for the services (with accounts), their tokens and the account scopes,
+    no matter how many services are linked. SocialApps come from the process cache. The
+    returned services already have their ServiceProvider built from the preloaded data.
+
+    Args:
+        services: Service QuerySet, i.e. user.service_set.all()
+
+    Returns:
+        list of Service
+    """
+    services = list(services.select_related('account').prefetch_related(
+        Prefetch('account__socialtoken_set', queryset=SocialToken.objects.order_by('-expires_at')),
+    ))
+    if not services:
+        return services
+
+    accounts = [service.account for service in services]
+
+    account_scopes = defaultdict(list)
+    for ups in UserProviderScope.objects.filter(account__in=accounts).select_related('scope'):
+        account_scopes[ups.account_id].append(ups)
+
+    for service in services:
+        service.get_service_provider(account_scopes=account_scopes[service.account_id])
+
+    return services
+
+
+async def aload_services(services):
+    """ Async version of load_services, built on the async ORM (Django 4.1+).
+
+    Everything the providers need later is loaded up front, including the SocialApps
+    and the scope catalog, so using them from async code never hits the database.
+    """
+    services = [service async for service in services.select_related('account')]
+    if not services:
+        return services
+
+    accounts = [service.account for service in services]
+    await scope_catalog.aensure_loaded()
+
+    tokens = {}
+    async for token in SocialToken.objects.filter(account__in=accounts).order_by('-expires_at'):
+        tokens.setdefault(token.account_id, token)
+
+    account_scopes = defaultdict(list)
+    async for ups in UserProviderScope.objects.filter(account__in=accounts).select_related('scope'):
+        account_scopes[ups.account_id].append(ups)
+
+    for service in services:
+        if service.account.provider not in SERVICE_PROVIDER_CLASSES:
+            continue
+        provider = service.get_service_provider(
+            client=await aget_social_app(service.account.provider),
+            account_scopes=account_scopes[service.account_id],
+        )
+        provider.token = tokens.get(service.account_id)
+        # From the catalog loaded above, the snapshot is built on the event loop
+        provider.preload_capabilities(scope_catalog.access_types(service.account.provider, load=False))
+
+    return services
+
+
+def registry_cache_key(user_id):
+    return f'service_interactor:registry:{user_id}'
+
+
+def build_registry_snapshot(services):
+    """ Compact, cacheable description of already loaded services and their providers. """
+    snapshot = []
+    for service in services:
+        provider = service.get_service_provider()
+        entry = {
+            'service_id': service.pk,
+            'user_id': service.user_id,
+            'account_id': service.account_id,
+            'provider_id': service.account.provider,
+            'uid': service.account.uid,
+            'name': str(service),
+        }
+        if provider:
+            entry.update({
+                'enabled': bool(provider.is_enabled),
+                'token_expires_at': provider.token_expires_at,
+                'capabilities': [sorted(provider.capabilities.available), sorted(provider.capabilities.granted)],
+            })
+        snapshot.append(entry)
+    return snapshot
+
+
+def load_services_from_snapshot(snapshot):
+    """ Rebuilds Service objects and their providers from build_registry_snapshot without any query.
+
+    Fields left out of the snapshot are deferred and loaded by Django on first access.
+    """
+    services = []
+    for entry in snapshot:
+        account = SocialAccount.from_db(
+            None, ['id', 'user_id', 'provider', 'uid'],
+            [entry['account_id'], entry['user_id'], entry['provider_id'], entry['uid']],
+        )
+        service = Service.from_db(None, ['id', 'user_id', 'account_id'], [
+            entry['service_id'], entry['user_id'], entry['account_id'],
+        ])
+        service.account = account
+        service._display_name = entry['name']
+        if 'capabilities' in entry:
+            service.get_service_provider(snapshot=entry)
+        services.append(service)
+    return services
+
+
+def load_user_services(user):
+    """ Loads the users services, from the registry snapshot cache when REGISTRY_CACHE is enabled.
+
+    The snapshot is removed by signals whenever the users Service, SocialAccount, SocialToken or
+    UserProviderScope rows change, and ignored once the scope catalog version moves on.
+    """
+    if not app_settings.REGISTRY_CACHE:
+        return load_services(user.service_set.all())
+
+    key = registry_cache_key(user.pk)
+    version = scope_catalog.version
+
+    cached = cache.get(key)
+    if cached and cached['version'] == version:
+        return load_services_from_snapshot(cached['services'])
+
+    services = load_services(user.service_set.all())
+    cache.set(key, {
+        'version': version,
+        'services': build_registry_snapshot(services),
+    }, app_settings.REGISTRY_CACHE_TIMEOUT)
+    return services
+
+
+async def aload_user_services(user):
+    """ Async version of load_user_services. """
+    if not app_settings.REGISTRY_CACHE:
+        return await aload_services(user.service_set.all())
+
+    key = registry_cache_key(user.pk)
+    version = await scope_catalog.aget_version()
+
+    cached = await cache.aget(key)
+    if cached and cached['version'] == version:
+        for entry in cached['services']:
+            if entry['provider_id'] in SERVICE_PROVIDER_CLASSES:
+                await aget_social_app(entry['provider_id'])
+        return load_services_from_snapshot(cached['services'])
+
+    services = await aload_services(user.service_set.all())
+    await cache.aset(key, {
+        'version': version,
+        'services': build_registry_snapshot(services),
+    }, app_settings.REGISTRY_CACHE_TIMEOUT)
+    return services
+
+
+def clear_registry_snapshot(user_id):
+    cache.delete(registry_cache_key(user_id))
@@ -0,0 +1,39 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...utils import refresh_expiring_tokens
+
+
+class Command(BaseCommand):
+    help = 'Refreshes social tokens that expire soon so users never wait on a token refresh.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=15,
+                            help='Refresh tokens expiring within this many minutes. Default 15.')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Maximum parallel refreshes per provider. Default 4.')
+        parser.add_argument('--provider', action='append', dest='providers',
+                            help='Only refresh tokens of this provider id, may be repeated.')
+        parser.add_argument('--loop', type=int, default=0,
+                            help='Keep running, sleeping this many seconds between runs.')
+
+    def handle(self, *args, **options):
+        window = datetime.timedelta(minutes=options['window'])
+
+        while True:
+            results = refresh_expiring_tokens(
+                window=window,
+                max_workers=options['workers'],
+                providers=options['providers'],
+            )
+
+            if not results:
+                self.stdout.write('No tokens to refresh.')
+            for provider_id, counts in results.items():
+                self.stdout.write(f"{provider_id}: {counts['refreshed']} refreshed, {counts['failed']} failed")
+
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
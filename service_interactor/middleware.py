@@ -1,103 +1,251 @@
+import asyncio
 from collections import OrderedDict
+from functools import partial
 
 from django.db.models import QuerySet
+from django.utils.functional import SimpleLazyObject
 
+from asgiref.sync import sync_to_async
+
+from .loaders import aload_user_services, load_services, load_user_services
 from .models import Service
 from .providers.base import ServiceProvider
 from .providers import GoogleServiceProvider
 
 
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
 class ServiceRegistry:
+    """ Holds a users Service objects along with their ServiceProvider.
+
+    When supplied a QuerySet nothing is loaded until the registry is first used, at which
+    point the services and their provider data are bulk loaded, see loaders.load_services.
+    """
 
     def __init__(self, services=None):
         self._ids = set()
         self._service_provider_map = OrderedDict()
-        self.services = []
-        self.providers = []
+        self._services = []
+        self._loader = None
+        self._aloader = None
 
         if isinstance(services, QuerySet):
-            for serv in services:
+            self._loader = lambda: load_services(services)
+
+    @classmethod
+    def for_user(cls, user):
+        """ Lazy registry of the users services, see loaders.load_user_services. """
+        registry = cls()
+        registry._loader = lambda: load_user_services(user)
+        registry._aloader = lambda: aload_user_services(user)
+        return registry
+
+    def _load(self):
+        if self._loader is None:
+            return
+        loader, self._loader, self._aloader = self._loader, None, None
+        for serv in loader():
+            self.register(serv)
+
+    async def aload(self):
+        """ Loads the registry with the async ORM when it has an async loader, returns the registry. """
+        if self._aloader is not None:
+            aloader, self._loader, self._aloader = self._aloader, None, None
+            for serv in await aloader():
                 self.register(serv)
+        elif self._loader is not None:
+            await sync_to_async(self._load)()
+        return self
 
     def register(self, service: Service, provider=None):
-        if not provider:
-            provider = service.get_service_provider()  # type: GoogleServiceProvider
+        self._load()
 
         self._ids.add(service.id)
-        self.services.append(service)
-        self.providers.append(provider)
+        self._services.append(service)
 
         self._service_provider_map[service.id] = {
             'service': service,
             'provider': provider
         }
 
+    @property
+    def services(self):
+        self._load()
+        return self._services
+
+    @property
+    def providers(self):
+        return [self.get_provider(service.id) for service in self.services]
+
     def __len__(self):
+        self._load()
         return len(self._service_provider_map)
 
     def __getitem__(self, item):
-        return self.services[item], self.providers[item]
+        service = self.services[item]
+        return service, self.get_provider(service.id)
 
     def __contains__(self, item):
+        self._load()
         if isinstance(item, int):
             return item in self._ids
         if issubclass(type(item), ServiceProvider):
             return item in self.providers
-        return item in self.services
+        return item in self._services
 
     def get_service(self, service_id):
+        self._load()
         return self._service_provider_map[service_id]['service']
 
     def get_provider(self, service_id):
-        return self._service_provider_map[service_id]['provider']
+        self._load()
+        data = self._service_provider_map[service_id]
+        if not data['provider']:
+            data['provider'] = data['service'].get_service_provider()  # type: GoogleServiceProvider
+        return data['provider']
+
+    def iter_enabled(self):
+        """ Yields (service, provider) for enabled providers, building each provider only as it is reached. """
+        for service in self.services:
+            provider = self.get_provider(service.id)
+            if provider and provider.is_enabled:
+                yield service, provider
 
     @property
     def enabled(self):
         items = ServiceRegistry()
-        for sic, data in self._service_provider_map.items():
-            if data['provider'] and data['provider'].is_enabled:
-                items.register(service=data['service'], provider=data['provider'])
+        for service, provider in self.iter_enabled():
+            items.register(service=service, provider=provider)
         return items
 
 
+def _resolve_active_service(registry, requested_id, session_id):
+    """ Picks the active (service, provider) pair from the registry.
+
+    Returns:
+        tuple of the (service, provider) pair and the id to store in the session, None when unchanged
+    """
+    if requested_id:
+        try:
+            requested_id = int(requested_id)
+        except (TypeError, ValueError):
+            requested_id = None
+
+    if requested_id and requested_id in registry:
+        return (registry.get_service(requested_id), registry.get_provider(requested_id)), requested_id
+
+    if session_id and session_id in registry:
+        return (registry.get_service(session_id), registry.get_provider(session_id)), None
+
+    for service, provider in registry.iter_enabled():
+        return (service, provider), service.pk
+
+    return (None, None), None
+
+
+def get_active_service(request):
+    """ Resolves and caches the (service, provider) pair that is active for this request. """
+    if hasattr(request, '_cached_active_service'):
+        return request._cached_active_service
+
+    active, new_session_id = _resolve_active_service(
+        request.service_accounts,
+        request.GET.get('service_id'),
+        request.session.get('active_service_provider_id'),
+    )
+    if new_session_id:
+        request.session['active_service_provider_id'] = new_session_id
+
+    request._cached_active_service = active
+    return active
+
+
+async def aget_active_service(request):
+    """ Async version of get_active_service. """
+    if hasattr(request, '_cached_active_service'):
+        return request._cached_active_service
+
+    session = request.session
+    if hasattr(session, 'aget'):
+        session_id = await session.aget('active_service_provider_id')
+    else:
+        session_id = await sync_to_async(session.get)('active_service_provider_id')
+
+    active, new_session_id = _resolve_active_service(
+        await request.service_accounts.aload(),
+        request.GET.get('service_id'),
+        session_id,
+    )
+    if new_session_id:
+        if hasattr(session, 'aset'):
+            await session.aset('active_service_provider_id', new_session_id)
+        else:
+            session['active_service_provider_id'] = new_session_id
+
+    request._cached_active_service = active
+    return active
+
+
+async def _aget_active_service_object(request):
+    return (await aget_active_service(request))[0]
+
+
+async def _aget_active_provider(request):
+    return (await aget_active_service(request))[1]
+
+
 class AddServiceProviderObjects(object):
+    """ Adds service_accounts, active_service and active_provider to authenticated requests.
+
+    Under ASGI the awaitable request.aservice_accounts(), request.aactive_service() and
+    request.aactive_provider() load the registry with the async ORM instead.
+    """
+
+    sync_capable = True
+    async_capable = True
 
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _add_service_objects(self, request, user):
+        request.service_accounts = ServiceRegistry.for_user(user)
+        request.active_service = SimpleLazyObject(lambda: get_active_service(request)[0])
+        request.active_provider = SimpleLazyObject(lambda: get_active_service(request)[1])
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
 
         if not request.user.is_authenticated:
             return self.get_response(request)
 
-        request.service_accounts = ServiceRegistry()
-
-        for service in request.user.service_set.filter():
-            request.service_accounts.register(service)
+        self._add_service_objects(request, request.user)
 
-        new_service_id = request.GET.get('service_id') or None
-        if new_service_id:
-            try:
-                new_service_id = int(new_service_id)
-                if new_service_id in request.service_accounts:
-                    request.session['active_service_provider_id'] = new_service_id
-            except (TypeError, ValueError):
-                new_service_id = None
+        return self.get_response(request)
 
-        active_spi = new_service_id or request.session.get('active_service_provider_id')
+    async def __acall__(self, request):
+        if hasattr(request, 'auser'):
+            user = await request.auser()
+        else:
+            # Evaluates the lazy request.user in a thread, it queries the database.
+            user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
 
-        if active_spi and active_spi in request.service_accounts:
-            request.active_service = request.service_accounts.get_service(active_spi)
-            request.active_provider = request.service_accounts.get_provider(active_spi)
+        if not user or not user.is_authenticated:
+            return await self.get_response(request)
 
-        else:
-            for service, provider in request.service_accounts.enabled:
-                request.active_service = service
-                request.active_provider = provider
-                request.session['active_service_provider_id'] = service.pk
-                break
-            else:
-                request.active_service = None
-                request.active_provider = None
+        self._add_service_objects(request, user)
+        request.aservice_accounts = request.service_accounts.aload
+        request.aactive_service = partial(_aget_active_service_object, request)
+        request.aactive_provider = partial(_aget_active_provider, request)
 
-        return self.get_response(request)
+        return await self.get_response(request)
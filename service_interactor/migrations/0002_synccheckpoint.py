@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('service_interactor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('gmail', 'Gmail history id'), ('drive', 'Drive changes page token'), ('calendar', 'Calendar events sync token')], max_length=20)),
+                ('key', models.CharField(blank=True, max_length=255)),
+                ('value', models.CharField(max_length=255)),
+                ('inserted', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('service', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_checkpoints', to='service_interactor.service')),
+            ],
+            options={
+                'unique_together': {('service', 'kind', 'key')},
+            },
+        ),
+    ]
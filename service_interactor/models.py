@@ -10,6 +10,13 @@ from .providers import (
 )
 
 
+SERVICE_PROVIDER_CLASSES = {
+    'google': GoogleServiceProvider,
+    'microsoft': MicrosoftServiceProvider,
+    'facebook': FacebookServiceProvider,
+}
+
+
 class Scope(models.Model):
     name = models.CharField(max_length=255)
     provider = models.CharField(max_length=255)
@@ -45,12 +52,15 @@ class Service(models.Model):
         super().__init__(*args, **kwargs)
 
         self._service_provider = None
+        self._display_name = None
 
     @property
     def name(self):
         return str(self)
 
     def __str__(self):
+        if self._display_name:
+            return self._display_name
         service_provider = self.get_service_provider()
         if service_provider:
             email = service_provider.get_email()
@@ -63,19 +73,52 @@ class Service(models.Model):
         else:
             return self.account.get_provider().name
 
-    def get_service_provider(self):
+    def get_service_provider(self, **kwargs):
+        """ Builds the ServiceProvider for this account once.
+
+        Args:
+            **kwargs: preloaded data passed to the provider, see ServiceProvider.__init__
+        """
         if not self._service_provider:
-            if self.account.provider == 'google':
-                self._service_provider = GoogleServiceProvider(account=self.account)
-            elif self.account.provider == 'microsoft':
-                self._service_provider = MicrosoftServiceProvider(account=self.account)
-            elif self.account.provider == 'facebook':
-                self._service_provider = FacebookServiceProvider(account=self.account)
+            provider_class = SERVICE_PROVIDER_CLASSES.get(self.account.provider)
+            if provider_class:
+                self._service_provider = provider_class(account=self.account, **kwargs)
+                self._service_provider.service = self
         return self._service_provider
 
+
 #     def get_settings(self):
 #         return
 #
 #
 # class ProviderSetting(models.Model):
 #     pass
+
+
+class SyncCheckpoint(models.Model):
+    """ Where the last completed sync of a Service stopped, see GoogleServiceProvider._checkpointed_sync
+
+    key tells apart checkpoints of the same kind, the Drive consumer name or the calendar id.
+    """
+    GMAIL = 'gmail'
+    DRIVE = 'drive'
+    CALENDAR = 'calendar'
+    KIND_CHOICES = (
+        (GMAIL, 'Gmail history id'),
+        (DRIVE, 'Drive changes page token'),
+        (CALENDAR, 'Calendar events sync token'),
+    )
+
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='sync_checkpoints')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    key = models.CharField(max_length=255, blank=True)
+    value = models.CharField(max_length=255)
+
+    inserted = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('service', 'kind', 'key')]
+
+    def __str__(self):
+        return f'{self.service_id} {self.kind} {self.key}: {self.value}'
@@ -1,12 +1,26 @@
+import datetime
+import threading
+from collections import namedtuple
+
+from django.db import transaction
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.html import mark_safe
 
-from allauth.socialaccount.models import SocialAccount, SocialApp
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
 
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
+from ..caches import account_scope_versions, get_social_app, scope_catalog
+from ..transport import SharedSessionRequest
+
+
+# access_type values the provider offers scopes for and those granted to the account.
+Capabilities = namedtuple('Capabilities', ['available', 'granted'])
+
+# One lock per SocialToken id, held by the thread refreshing that token.
+_token_refresh_locks = {}
+
 
 class ServiceProvider(object):
     provider_id = None
@@ -17,41 +31,120 @@ class ServiceProvider(object):
     token_uri = None
     requires_token_secret = False
 
-    def __init__(self, account: SocialAccount):
-        self.client = SocialApp.objects.get(provider=self.provider_id)
+    # Tokens expiring within this window are refreshed
+    token_refresh_leeway = datetime.timedelta(minutes=5)
+
+    def __init__(self, account: SocialAccount, client: SocialApp = None, account_scopes=None, snapshot=None):
+        """
+        Args:
+            account: SocialAccount this provider acts on behalf of
+            client: preloaded SocialApp for this provider, taken from the process cache when not supplied
+            account_scopes: preloaded list of UserProviderScope (with scope) for the account
+            snapshot: dict with enabled, token_expires_at and capabilities from a cached
+                registry snapshot, see loaders.load_user_services
+        """
+        self.client = client or get_social_app(self.provider_id)
         self.account = account
-        self.token = self._get_social_token()
+        self._account_scopes = account_scopes
+        self._capabilities = None
+        self._scopes_version = account_scope_versions.get(account.pk)
+
+        self._snapshot = snapshot
+        if snapshot:
+            self._capabilities = Capabilities(*(frozenset(c) for c in snapshot['capabilities']))
 
     @cached_property
-    def credentials(self):
+    def token(self):
+        return self._get_social_token()
 
-        if not self.token_uri:
-            raise ValueError(f'Missing token_uri attribute on {self.__class__.__name__} class')
-        if not self.token:
-            raise ValueError(f'Invalid Social Token for {self.__class__.__name__}')
-        if not self.token.token_secret:
-            raise ValueError('Token Refresh Missing')
+    @cached_property
+    def service(self):
+        """ The Service this provider belongs to, set by Service.get_service_provider. """
+        from ..models import Service
+        return Service.objects.filter(account=self.account).first()
+
+    def require_service(self):
+        """ The Service this provider belongs to, raises ValueError when the account has none. """
+        if self.service is None:
+            raise ValueError(
+                f'{self.account} has no Service, build the provider with Service.get_service_provider()'
+            )
+        return self.service
 
+    def _build_credentials(self):
         creds = Credentials(
             token=self.token.token,
             refresh_token=self.token.token_secret,
             # scopes=settings.SOCIALACCOUNT_PROVIDERS['google']['SCOPE'],
-            scopes=list(self.get_account_scopes().values_list('scope__name', flat=True)),
+            scopes=[es.scope.name for es in self.get_account_scope_objects()],
             token_uri=self.token_uri,
 
             client_id=self.client.client_id,
             client_secret=self.client.secret
         )
-        creds.expiry = timezone.make_naive(self.token.expires_at)
+        if self.token.expires_at:
+            creds.expiry = timezone.make_naive(self.token.expires_at)
+        return creds
+
+    @cached_property
+    def credentials(self):
+
+        if not self.token_uri:
+            raise ValueError(f'Missing token_uri attribute on {self.__class__.__name__} class')
+        if not self.token:
+            raise ValueError(f'Invalid Social Token for {self.__class__.__name__}')
+        if not self.token.token_secret:
+            raise ValueError('Token Refresh Missing')
+
+        creds = self._build_credentials()
 
         if not creds.valid or creds.expired:
-            self._refresh_token(creds)
+            creds = self._refresh_credentials(creds)
 
         return creds
 
+    def refresh_credentials(self, force=False, leeway=None, rejected=False):
+        """ Refreshes the cached credentials when they are no longer valid.
+
+        Args:
+            force: refresh unless the token stays valid for longer than leeway
+            leeway: timedelta, defaults to token_refresh_leeway
+            rejected: the API refused the current token, refresh unless another worker already did
+
+        Returns:
+            The current credentials
+        """
+        creds = self.credentials
+        if force or rejected or not creds.valid:
+            creds = self.__dict__['credentials'] = self._refresh_credentials(creds, leeway=leeway, rejected=rejected)
+        return creds
+
+    def _refresh_credentials(self, credentials, leeway=None, rejected=False):
+        """ Refreshes the token once across threads and workers.
+
+        The token row is locked with select_for_update, a worker that waited on the lock
+        picks up the token saved by the one that refreshed it instead of refreshing again.
+        """
+        leeway = leeway or self.token_refresh_leeway
+
+        with _token_refresh_locks.setdefault(self.token.pk, threading.Lock()):
+            with transaction.atomic():
+                self.token = SocialToken.objects.select_for_update().get(pk=self.token.pk)
+
+                if rejected:
+                    if self.token.token != credentials.token:
+                        return self._build_credentials()
+                elif self.token.expires_at and self.token.expires_at > timezone.now() + leeway:
+                    return self._build_credentials()
+
+                if self.token.token != credentials.token:
+                    credentials = self._build_credentials()
+                self._refresh_token(credentials)
+                return credentials
+
     def _refresh_token(self, credentials):
         print('Refreshing', self.account, self.account.provider)
-        credentials.refresh(Request())
+        credentials.refresh(SharedSessionRequest())
 
         if credentials.expiry:
             self.token.expires_at = timezone.make_aware(credentials.expiry)
@@ -63,13 +156,48 @@ class ServiceProvider(object):
         self.token.save()
 
     def _get_social_token(self):
-        for token in self.account.socialtoken_set.all().order_by('-expires_at'):
+        tokens = self.account.socialtoken_set.all()
+        # Prefetched tokens are already ordered, see loaders.load_services
+        if 'socialtoken_set' not in getattr(self.account, '_prefetched_objects_cache', {}):
+            tokens = tokens.order_by('-expires_at')
+        for token in tokens:
             return token
 
     def get_account_scopes(self, **kwargs):
         from ..models import UserProviderScope
         return UserProviderScope.objects.filter(account=self.account, **kwargs)
 
+    def _check_scopes_version(self):
+        """ Drops scope data loaded before the accounts UserProviderScope rows last changed. """
+        version = account_scope_versions.get(self.account.pk)
+        if version != self._scopes_version:
+            self._scopes_version = version
+            self._account_scopes = None
+            self._capabilities = None
+
+    def get_account_scope_objects(self):
+        """ All UserProviderScope objects (with their scope) for the account, loaded once. """
+        self._check_scopes_version()
+        if self._account_scopes is None:
+            self._account_scopes = list(self.get_account_scopes().select_related('scope'))
+        return self._account_scopes
+
+    @property
+    def capabilities(self):
+        """ Capabilities of this provider and account, computed once from the scope catalog and account scopes. """
+        self._check_scopes_version()
+        if self._capabilities is None:
+            self.preload_capabilities(scope_catalog.access_types(self.provider_id))
+        return self._capabilities
+
+    def preload_capabilities(self, available):
+        """ Computes capabilities from the supplied access types the provider offers, see loaders.aload_services. """
+        granted = set()
+        for es in self.get_account_scope_objects():
+            if es.scope.grants_access and es.scope.provider == self.provider_id:
+                granted.add(es.scope.access_type)
+        self._capabilities = Capabilities(frozenset(available), frozenset(granted))
+
     @classmethod
     def get_provider_scopes(cls, **kwargs):
         from ..models import Scope
@@ -77,73 +205,84 @@ class ServiceProvider(object):
 
     def get_new_scopes(self, **kwargs):
         scopes = set()
-        for es in self.get_account_scopes():
+        for es in self.get_account_scope_objects():
             scopes.add(es.scope.name)
         if kwargs:
-            for s in self.get_provider_scopes(**kwargs):
+            for s in scope_catalog.filter(self.provider_id, **kwargs):
                 scopes.add(s.name)
         return scopes
 
     def setup_default_scopes(self):
         from ..models import UserProviderScope
-        for scope in self.get_provider_scopes(required=True):
+        for scope in scope_catalog.filter(self.provider_id, required=True):
             UserProviderScope.objects.get_or_create(
                 account=self.account,
                 scope=scope
             )
 
+    def _get_access_granted_datetime(self, access_type):
+        for es in self.get_account_scope_objects():
+            if es.scope.access_type == access_type and es.scope.grants_access:
+                return es.inserted
+
     def get_calendar_access_granted_datetime(self):
-        for es in self.get_account_scopes(scope__access_type='calendar', scope__grants_access=True):
-            return es.inserted
+        return self._get_access_granted_datetime('calendar')
 
     def get_files_access_granted_datetime(self):
-        for es in self.get_account_scopes(scope__access_type='files', scope__grants_access=True):
-            return es.inserted
+        return self._get_access_granted_datetime('files')
 
     def get_email(self):
         return self.account.extra_data.get('email')
 
+    @property
+    def token_expires_at(self):
+        if self._snapshot and 'token' not in self.__dict__:
+            return self._snapshot['token_expires_at']
+        return self.token.expires_at if self.token else None
+
     @property
     def is_enabled(self):
+        if self._snapshot and 'token' not in self.__dict__:
+            return self._snapshot['enabled']
         if self.requires_token_secret:
             return self.token and self.token.token
         return self.token
 
+    def _has_access(self, access_type):
+        # granted only ever holds access types the provider has scopes for
+        return bool(self.is_enabled) and access_type in self.capabilities.granted
+
     @property
     def has_calendar_access(self):
-        return self.provider_has_calendar_abilities and self.is_enabled and \
-               self.get_account_scopes().filter(scope__access_type='calendar', scope__grants_access=True).exists()
+        return self._has_access('calendar')
 
     @property
     def has_file_access(self):
-        return self.provider_has_files_abilities and self.is_enabled and \
-               self.get_account_scopes().filter(scope__access_type='files', scope__grants_access=True).exists()
+        return self._has_access('files')
 
     @property
     def has_youtube_access(self):
-        return self.provider_has_youtube_abilities and self.is_enabled and \
-               self.get_account_scopes().filter(scope__access_type='youtube', scope__grants_access=True).exists()
+        return self._has_access('youtube')
 
     @property
     def has_email_access(self):
-        return self.provider_has_email_abilities and self.is_enabled and \
-               self.get_account_scopes().filter(scope__access_type='email', scope__grants_access=True).exists()
+        return self._has_access('email')
 
     @property
     def provider_has_calendar_abilities(self):
-        return self.get_provider_scopes(access_type='calendar').exists()
+        return 'calendar' in self.capabilities.available
 
     @property
     def provider_has_files_abilities(self):
-        return self.get_provider_scopes(access_type='files').exists()
+        return 'files' in self.capabilities.available
 
     @property
     def provider_has_youtube_abilities(self):
-        return self.get_provider_scopes(access_type='youtube').exists()
+        return 'youtube' in self.capabilities.available
 
     @property
     def provider_has_email_abilities(self):
-        return self.get_provider_scopes(access_type='email').exists()
+        return 'email' in self.capabilities.available
 
     def get_current_access_scopes_url(self):
         return mark_safe(','.join(self.get_new_scopes()))
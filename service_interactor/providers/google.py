@@ -1,16 +1,62 @@
 import pytz
 import dateutil.parser
+import contextlib
+import hashlib
 import io
+import itertools
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from django.utils.functional import cached_property
 from django.utils import timezone
 
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import DEFAULT_CHUNK_SIZE, MediaIoBaseDownload, MediaIoBaseUpload
 
 from .base import ServiceProvider
 from .. import service_objects
-from ..helpers import GmailHelper, YouTubeHelper
+from ..app_settings import app_settings
+from ..caches import DriveFolderIndex, drive_folders
+from ..discovery import get_discovery_document
+from ..downloads import DriveDownloadManager
+from ..helpers import GmailChange, GmailHelper, GmailHistoryExpired, YouTubeHelper
+from ..transport import AuthorizedHttp
+from ..utils import run_in_worker
+
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# events.list parameters that cannot be combined with a syncToken
+CALENDAR_FULL_SYNC_PARAMS = {
+    'iCalUID', 'orderBy', 'privateExtendedProperty', 'q', 'sharedExtendedProperty', 'timeMin', 'timeMax', 'updatedMin',
+}
+
+
+def _quote(value):
+    """ Quotes a string for a Drive files.list query. """
+    value = value.replace('\\', '\\\\').replace("'", "\\'")
+    return f"'{value}'"
+
+
+def _files_list_fields(fields):
+    """ Expands file fields into a files.list field mask that keeps nextPageToken. """
+    if not isinstance(fields, str):
+        fields = ', '.join(fields)
+    if 'files(' not in fields:
+        fields = f'files({fields})'
+    if 'nextPageToken' not in fields:
+        fields = f'nextPageToken, {fields}'
+    return fields
+
+
+class RangeMediaDownload(MediaIoBaseDownload):
+    """ MediaIoBaseDownload that starts at byte offset start, used to resume partial downloads. """
+
+    def __init__(self, fd, request, chunksize=DEFAULT_CHUNK_SIZE, start=0):
+        super().__init__(fd, request, chunksize=chunksize)
+        self._progress = start
 
 
 class GoogleServiceProvider(ServiceProvider):
@@ -22,8 +68,30 @@ class GoogleServiceProvider(ServiceProvider):
     requires_token_secret = True
     token_uri = 'https://accounts.google.com/o/oauth2/token'
 
-    def resource(self, service_name, version='v3', cache_discovery=False):
-        return build(service_name, version, credentials=self.credentials, cache_discovery=cache_discovery)
+    # Default files.list field mask and page size (the maximum Drive allows), see get_files
+    drive_file_fields = 'id, name, mimeType, parents, size, createdTime, modifiedTime'
+    drive_page_size = 1000
+    drive_folder_fields = 'id, name, mimeType, parents'
+
+    # Bytes requested per range request by download_file and download_google_doc_file
+    drive_download_chunk_size = 10 * 1024 * 1024
+
+    # Bytes sent per request by upload_file, Drive requires a multiple of 256KB
+    drive_upload_chunk_size = 10 * 1024 * 1024
+
+    # Events requested per events.list page, the maximum Calendar allows
+    calendar_page_size = 2500
+
+    @cached_property
+    def authorized_http(self):
+        """ Transport shared by every service built by resource(), see transport.AuthorizedHttp. """
+        return AuthorizedHttp(self)
+
+    def resource(self, service_name, version='v3', cache_discovery=True):
+        """ Builds a googleapiclient service, see discovery.get_discovery_document for the document caching. """
+        if not cache_discovery:
+            return build(service_name, version, http=self.authorized_http, cache_discovery=False)
+        return build_from_document(get_discovery_document(service_name, version), http=self.authorized_http)
 
     @cached_property
     def calendar_service(self):
@@ -45,76 +113,283 @@ class GoogleServiceProvider(ServiceProvider):
     def youtube_service(self):
         return self.resource(service_name='youtube', version='v3')
 
-    def get_files(self, **kwargs):
+    def get_files(self, fields=None, page_size=None, prefetch=True, **kwargs):
         """ Obtain all of the users Drive files. Yields results as it queries data.
 
+        While the current page is consumed the next one is requested in a background thread.
+
         References:
             https://developers.google.com/drive/api/v3/reference/files/list
+            https://developers.google.com/drive/api/v3/fields-parameter
 
         Args:
+            fields: file fields to return, a string or list, defaults to drive_file_fields.
+                A full mask such as 'nextPageToken, files(id)' is passed through as is.
+            page_size: files per page, defaults to drive_page_size
+            prefetch: request the next page while the current one is consumed
             **kwargs: see references
 
         Returns:
             Yields a dict for a single file
         """
-        while True:
-            files_resource = self.drive_service.files().list(**kwargs).execute()
-
-            next_page_token = files_resource.get('nextPageToken')
+        kwargs['fields'] = _files_list_fields(fields or self.drive_file_fields)
+        kwargs.setdefault('pageSize', page_size or self.drive_page_size)
 
+        for files_resource in self._list_pages(self.drive_service.files(), prefetch=prefetch, **kwargs):
             for file in files_resource.get('files', []):
                 yield file
 
-            if next_page_token:
-                kwargs['pageToken'] = next_page_token
-            else:
-                break
+    @staticmethod
+    def _list_pages(resource, prefetch=True, **kwargs):
+        """ Yields every page of resource.list(**kwargs), requesting the next page in a thread when prefetching. """
+        response = resource.list(**kwargs).execute()
+
+        with ThreadPoolExecutor(max_workers=1) if prefetch else contextlib.nullcontext() as executor:
+            while True:
+                next_page_token = response.get('nextPageToken')
+                pending = None
+                if next_page_token:
+                    request = resource.list(**dict(kwargs, pageToken=next_page_token))
+                    if executor:
+                        pending = executor.submit(run_in_worker, request.execute)
+
+                yield response
+
+                if not next_page_token:
+                    break
+                response = pending.result() if pending else request.execute()
+
+    def get_drive_start_page_token(self):
+        """ Page token for changes made from now on, see get_drive_changes. """
+        return self.drive_service.changes().getStartPageToken().execute()['startPageToken']
+
+    def get_drive_changes(self, page_token, fields=None, page_size=None, prefetch=True, **kwargs):
+        """ Yields a FileChange for every file added, modified or removed after page_token.
 
-    def download_google_doc_file(self, file_id, mime_type):
+        Trashed files are reported as removed.
+
+        References:
+            https://developers.google.com/drive/api/guides/manage-changes
+            https://developers.google.com/drive/api/v3/reference/changes/list
+
+        Args:
+            page_token: token from get_drive_start_page_token or a previous call
+            fields: file fields to return for each change, defaults to drive_file_fields
+            page_size: changes per page, defaults to drive_page_size
+            prefetch: request the next page while the current one is consumed
+            **kwargs: see references
+
+        Returns:
+            The page token to continue from next time, as the generators return value
+        """
+        fields = fields or self.drive_file_fields
+        if not isinstance(fields, str):
+            fields = ', '.join(fields)
+        if 'trashed' not in fields:
+            fields = f'{fields}, trashed'
+        kwargs['fields'] = f'nextPageToken, newStartPageToken, changes(fileId, removed, time, file({fields}))'
+        kwargs.setdefault('pageSize', page_size or self.drive_page_size)
+
+        new_page_token = page_token
+        pages = self._list_pages(self.drive_service.changes(), prefetch=prefetch, pageToken=page_token, **kwargs)
+        for page in pages:
+            new_page_token = page.get('newStartPageToken', new_page_token)
+            for change in page.get('changes', []):
+                if not change.get('fileId'):
+                    continue
+                file = change.get('file')
+                yield service_objects.FileChange(
+                    file_id=change['fileId'],
+                    removed=bool(change.get('removed') or (file and file.get('trashed'))),
+                    file=file,
+                    changed=dateutil.parser.parse(change['time']) if change.get('time') else None,
+                    raw=change,
+                )
+        return new_page_token
+
+    def sync_drive(self, name='default', fields=None, q=None):
+        """ Yields a FileChange for every file change since the last completed sync, see _checkpointed_sync.
+
+        The first sync lists every file that is not trashed as a change with full_sync set.
+
+        Args:
+            name: consumer of the changes, each name keeps its own page token
+            fields: file fields to return, defaults to drive_file_fields
+            q: limits the first full listing, later changes are not filtered by it
+
+        Raises:
+            ValueError: the provider has no Service to keep the checkpoint for
+        """
+        return self._checkpointed_sync('drive', name, lambda page_token: self._sync_drive(page_token, fields, q))
+
+    def _sync_drive(self, page_token, fields=None, q=None):
+        if page_token:
+            return (yield from self.get_drive_changes(page_token, fields=fields))
+
+        page_token = self.get_drive_start_page_token()
+        q = f'({q}) and trashed = false' if q else 'trashed = false'
+        for file in self.get_files(fields=fields, q=q):
+            yield service_objects.FileChange(file_id=file['id'], file=file, full_sync=True, raw=file)
+        return page_token
+
+    def _checkpointed_sync(self, kind, key, sync):
+        """ Yields the changes of sync and stores the checkpoint it returns once every change has been consumed.
+
+        Checkpoints are kept per Service, kind and key in SyncCheckpoint. Stopping early leaves the
+        stored checkpoint as it was, the next sync repeats those changes. A full listing should take
+        its checkpoint before listing so changes made during the listing are picked up next time.
+
+        Args:
+            kind: SyncCheckpoint kind
+            key: tells apart checkpoints of the same kind
+            sync: generator function receiving the stored checkpoint, None on the first sync,
+                and returning the new one, nothing is stored when it returns None
+
+        Raises:
+            ValueError: the provider has no Service to keep the checkpoint for, raised before any request
+        """
+        from ..models import SyncCheckpoint
+
+        service = self.require_service()
+
+        def run():
+            checkpoint = SyncCheckpoint.objects.filter(service=service, kind=kind, key=key).first()
+            value = yield from sync(checkpoint.value if checkpoint else None)
+            if value:
+                SyncCheckpoint.objects.update_or_create(service=service, kind=kind, key=key, defaults={'value': value})
+
+        return run()
+
+    def download_google_doc_file(self, file_id, mime_type, destination=None, chunk_size=None, progress=None):
         """ Downloads a specific Google Document file by ID from the users Google Drive. Maximum 10MB in size.
 
+        Exports cannot be resumed, Drive does not honour range requests for them.
+
         References:
              https://developers.google.com/drive/api/v3/reference/files/export
 
         Args:
             file_id: File ID to download
             mime_type: mimeType expected
+            destination: path or writable binary stream to write to, in memory when not supplied
+            chunk_size: bytes requested per chunk, defaults to drive_download_chunk_size
+            progress: callable receiving (bytes downloaded, total bytes or None) after each chunk
 
         Returns:
-            File handle for the file in memory
+            The destination, or a file handle for the file in memory
         """
         media = self.drive_service.files().export_media(fileId=file_id, mimeType=mime_type)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, media)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-            # print(f'Download {status.progress() * 100}%')
-        fh.seek(0)
-        return fh
+        return self._download_media(media, destination, chunk_size=chunk_size, progress=progress)
 
-    def download_file(self, file_id):
+    def download_file(self, file_id, destination=None, chunk_size=None, progress=None, resume=False):
         """ Downloads a specific file by ID from the users Google Drive.
 
+        Chunks are written to the destination as they arrive so the file is never held in memory,
+        unless no destination is supplied.
+
         References:
              https://developers.google.com/drive/api/v3/reference/files/export
              https://developers.google.com/drive/api/v3/manage-downloads#downloading_a_file
 
         Args:
             file_id: File ID to download
+            destination: path or writable binary stream to write to, in memory when not supplied
+            chunk_size: bytes requested per chunk, defaults to drive_download_chunk_size
+            progress: callable receiving (bytes downloaded, total bytes or None) after each chunk
+            resume: continue a partial download, from the end of the file at a path or the
+                current position of a stream, with a range request
 
         Returns:
-            File handle for the file in memory
+            The destination, or a file handle for the file in memory
         """
         media = self.drive_service.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, media)
+        return self._download_media(
+            media, destination, chunk_size=chunk_size, progress=progress, resume=resume,
+            verify=lambda fh, size: self._is_complete_copy(file_id, fh, size),
+        )
+
+    def _is_complete_copy(self, file_id, fh, size):
+        """ Whether the first size bytes of fh match the Drive file, by size and md5Checksum when Drive has one. """
+        details = self.get_file_details(file_id, fields='size, md5Checksum')
+        if details.get('size') is None or int(details['size']) != size:
+            return False
+
+        if details.get('md5Checksum'):
+            md5 = hashlib.md5()
+            try:
+                fh.seek(0)
+                remaining = size
+                while remaining:
+                    data = fh.read(min(remaining, self.drive_download_chunk_size))
+                    if not data:
+                        return False
+                    md5.update(data)
+                    remaining -= len(data)
+            except (io.UnsupportedOperation, OSError):
+                # A write only stream, only the size can be compared
+                return True
+            finally:
+                fh.seek(size)
+            return md5.hexdigest() == details['md5Checksum']
+        return True
+
+    def _download_media(self, request, destination=None, chunk_size=None, progress=None, resume=False, verify=None):
+        if isinstance(destination, (str, os.PathLike)):
+            # Opened for reading as well so a resumed copy can be verified, see _write_media
+            resume = resume and os.path.exists(destination)
+            with open(destination, 'r+b' if resume else 'wb') as fh:
+                fh.seek(0, os.SEEK_END)
+                self._write_media(request, fh, chunk_size, progress, start=fh.tell(), verify=verify)
+            return destination
+
+        fh = io.BytesIO() if destination is None else destination
+        self._write_media(request, fh, chunk_size, progress, start=fh.tell() if resume else 0, verify=verify)
+        if destination is None:
+            fh.seek(0)
+        return fh
+
+    def _write_media(self, request, fh, chunk_size=None, progress=None, start=0, verify=None):
+        """ Downloads request into fh from byte start.
+
+        Drive answers 416 when start is at or past the end of the file. The local copy is only
+        kept when verify(fh, start) confirms it matches, otherwise the download starts over.
+        """
+        chunk_size = chunk_size or self.drive_download_chunk_size
+        downloader = RangeMediaDownload(fh, request, chunksize=chunk_size, start=start)
         done = False
         while not done:
-            status, done = downloader.next_chunk()
-            # print(f'Download {status.progress() * 100}%')
-        fh.seek(0)
-        return fh
+            try:
+                status, done = downloader.next_chunk()
+            except HttpError as e:
+                if not start or e.resp.status != 416:
+                    raise
+                if verify and verify(fh, start):
+                    break
+                fh.seek(0)
+                fh.truncate()
+                start = 0
+                downloader = RangeMediaDownload(fh, request, chunksize=chunk_size)
+                continue
+            if progress:
+                progress(status.resumable_progress, status.total_size)
+
+    def download_files(self, files, directory=None, max_workers=4, retries=3, max_bytes_per_second=None,
+                       chunk_size=None, progress=None):
+        """ Downloads many files at the same time, see downloads.DriveDownloadManager for the arguments.
+
+        Returns:
+            dict of file id to downloads.DownloadResult
+        """
+        manager = DriveDownloadManager(
+            self,
+            directory=directory,
+            max_workers=max_workers,
+            retries=retries,
+            max_bytes_per_second=max_bytes_per_second,
+            chunk_size=chunk_size,
+            progress=progress,
+        )
+        return manager.download(files)
 
     def get_file_details(self, file_id, **kwargs):
         """ Obtain a specific file's information, see ref below for available fields
@@ -131,19 +406,181 @@ class GoogleServiceProvider(ServiceProvider):
         """
         return self.drive_service.files().get(fileId=file_id, **kwargs).execute()
 
-    def get_folders(self, name=None):
-        q = 'mimeType="application/vnd.google-apps.folder" and trashed = false'
-        if name:
-            q = f'{q} and name = "{name}"'
-        return self.get_files(q=q)
+    def get_folder_index(self, refresh=False):
+        """ Every folder of the account from a single listing, kept for DRIVE_FOLDER_CACHE_TIMEOUT seconds.
 
-    def get_or_create_folder(self, name):
-        # Get or create the folder
-        for folder in self.get_folders(name=name):
+        Returns:
+            caches.DriveFolderIndex
+        """
+        if refresh:
+            drive_folders.clear(self.account.pk)
+        timeout = app_settings.DRIVE_FOLDER_CACHE_TIMEOUT
+        return drive_folders.get(self.account.pk, self._load_folder_index, timeout)
+
+    def _load_folder_index(self):
+        root_id = self.get_file_details('root', fields='id')['id']
+        q = f"mimeType='{FOLDER_MIME_TYPE}' and trashed = false"
+        folders = self.get_files(fields=self.drive_folder_fields, q=q)
+        return DriveFolderIndex(root_id, folders)
+
+    def _find_folder(self, parent_id, name):
+        """ Queries Drive for a folder created since the index was loaded. """
+        q = f"mimeType='{FOLDER_MIME_TYPE}' and trashed = false"
+        q = f'{q} and name = {_quote(name)} and {_quote(parent_id)} in parents'
+        for folder in self.get_files(fields=self.drive_folder_fields, q=q, prefetch=False):
             return folder
+
+    def resolve_folder(self, path, parent=None, create=False):
+        """ Folder for a path of names separated by / such as 'a/b/c'.
+
+        Folders come from get_folder_index, Drive is only queried for folders missing from it.
+        Missing folders are created while holding the accounts folder lock so concurrent jobs
+        in this process create each one once. The lock does not reach other processes or hosts,
+        jobs there can still create the same folder twice.
+
+        Args:
+            path: folder names separated by /
+            parent: id of the folder the path starts in, defaults to the root of My Drive
+            create: create missing folders instead of returning None
+
+        Returns:
+            dict of the last folder in the path, None when it does not exist
+        """
+        index = self.get_folder_index()
+        parent_id = index.root_id if parent in (None, 'root') else parent
+
+        folder = None
+        for name in [segment for segment in path.split('/') if segment]:
+            folder = index.child(parent_id, name)
+            if folder is None:
+                with drive_folders.lock(self.account.pk):
+                    folder = index.child(parent_id, name) or self._find_folder(parent_id, name)
+                    if folder is None and create:
+                        folder_metadata = {'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent_id]}
+                        folder = self.drive_service.files().create(
+                            body=folder_metadata,
+                            fields=self.drive_folder_fields,
+                        ).execute()
+                    if folder is None:
+                        return None
+                    index.add(folder)
+            parent_id = folder['id']
+        return folder
+
+    def get_folders(self, name=None, parent=None):
+        """ Folders of the account, served from get_folder_index.
+
+        Args:
+            name: folder name, or a path such as 'a/b/c' to return c from inside a/b
+            parent: id of the folder to list, every folder is searched when not supplied
+
+        Returns:
+            list of folder dicts
+        """
+        index = self.get_folder_index()
+
+        if name and '/' in name.strip('/'):
+            path, name = name.strip('/').rsplit('/', 1)
+            parent_folder = self.resolve_folder(path, parent=parent)
+            if not parent_folder:
+                return []
+            parent = parent_folder['id']
+
+        if parent:
+            folders = index.children(index.root_id if parent == 'root' else parent)
+        else:
+            folders = index.all()
+        return [folder for folder in folders if not name or folder['name'] == name]
+
+    def get_or_create_folder(self, name, parent=None):
+        """ Folder by name or path, missing folders are created, see resolve_folder.
+
+        A bare name without a parent matches a folder of that name anywhere, and is created
+        in the root of My Drive when there is none.
+        """
+        if not parent and '/' not in name.strip('/'):
+            for folder in self.get_folders(name=name):
+                return folder
+        return self.resolve_folder(name, parent=parent, create=True)
+
+    def upload_file(self, source, name=None, folder=None, parent=None, mime_type=None, chunk_size=None,
+                    resumable_uri=None, on_session=None, progress=None, **metadata):
+        """ Uploads a file to the users Google Drive with the resumable protocol, one chunk at a time.
+
+        References:
+            https://developers.google.com/drive/api/guides/manage-uploads#resumable
+            https://developers.google.com/drive/api/v3/reference/files/create
+
+        Args:
+            source: path or binary file object, a file object is uploaded from its start
+            name: file name in Drive, defaults to the name of the source
+            folder: path of the folder to upload into, created when missing, see get_or_create_folder
+            parent: id of the folder to upload into, instead of folder
+            mime_type: defaults to the type guessed from the name
+            chunk_size: bytes sent per request, a multiple of 256KB, defaults to drive_upload_chunk_size
+            resumable_uri: upload session url passed to on_session by an interrupted upload of the
+                same source, the upload continues from the last byte Drive received
+            on_session: callable receiving the upload session url once it is created, persist it
+                to resume the upload after a failure
+            progress: callable receiving (bytes uploaded, total bytes) after each chunk
+            **metadata: additional file metadata, see references
+
+        Returns:
+            dict of the created file with the drive_file_fields
+        """
+        if isinstance(source, (str, os.PathLike)):
+            name = name or os.path.basename(source)
         else:
-            folder_metadata = {'name': name, 'mimeType': 'application/vnd.google-apps.folder'}
-            return self.drive_service.files().create(body=folder_metadata).execute()
+            name = name or os.path.basename(getattr(source, 'name', None) or '') or None
+
+        if name:
+            metadata['name'] = name
+        if folder and not parent:
+            parent = self.get_or_create_folder(folder)['id']
+        if parent:
+            metadata['parents'] = [parent]
+
+        mime_type = mime_type or (name and mimetypes.guess_type(name)[0]) or 'application/octet-stream'
+        chunk_size = chunk_size or self.drive_upload_chunk_size
+
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as fh:
+                return self._upload_media(fh, metadata, mime_type, chunk_size, resumable_uri, on_session, progress)
+        return self._upload_media(source, metadata, mime_type, chunk_size, resumable_uri, on_session, progress)
+
+    def _upload_media(self, fh, metadata, mime_type, chunk_size, resumable_uri=None, on_session=None, progress=None):
+        media = MediaIoBaseUpload(fh, mimetype=mime_type, chunksize=chunk_size, resumable=True)
+        request = self.drive_service.files().create(body=metadata, media_body=media, fields=self.drive_file_fields)
+
+        if resumable_uri:
+            # next_chunk asks Drive for the bytes it already has before sending more
+            request.resumable_uri = resumable_uri
+            request._in_error_state = True
+
+        session_uri = resumable_uri
+        response = None
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+            except HttpError as e:
+                # The session expired or is unknown, start over with a new one
+                if resumable_uri and request.resumable_uri == resumable_uri and e.resp.status in (404, 410):
+                    fh.seek(0)
+                    return self._upload_media(fh, metadata, mime_type, chunk_size, None, on_session, progress)
+                raise
+            finally:
+                if on_session and request.resumable_uri and request.resumable_uri != session_uri:
+                    session_uri = request.resumable_uri
+                    on_session(session_uri)
+            resumable_uri = None
+
+            if progress:
+                if status:
+                    progress(status.resumable_progress, status.total_size)
+                else:
+                    progress(media.size(), media.size())
+
+        return response
 
     def get_calendars(self):
         items = self.calendar_service.calendarList().list().execute()
@@ -155,40 +592,110 @@ class GoogleServiceProvider(ServiceProvider):
                 raw=calendar,
             )
 
-    def get_calendar_events(self, calendar_id, *args, **kwargs):
-        """
+    def get_calendar_events(self, calendar_id, prefetch=True, limit=None, **kwargs):
+        """ Yields the events of the calendar, requesting each page as the previous one is consumed.
 
-            self.get_events(timeMin=now, maxResults=10, singleEvents=True, orderBy='startTime')
+            # The upcoming 10 events
+            now = datetime.datetime.utcnow().isoformat() + 'Z'  # 'Z' indicates UTC time
+            for event in provider.get_calendar_events('primary', limit=10, timeMin=now, singleEvents=True,
+                                                      orderBy='startTime'):
+                print(event)
 
-            # Call the Calendar API
-            now = datetime.datetime.utcnow().isoformat() + 'Z' # 'Z' indicates UTC time
-            print('Getting the upcoming 10 events')
+        References:
+            https://developers.google.com/calendar/api/v3/reference/events/list
 
-            cal = Calendar.objects.get(user=u, primary=True)
-            for event in cal.get_events(timeMin=now, maxResults=10, singleEvents=True, orderBy='startTime'):
-                print(event)
+        Args:
+            calendar_id: Calendar ID to list
+            prefetch: request the next page while the current one is consumed
+            limit: stop after this many events, every event is yielded when not supplied
+            **kwargs: see references, maxResults is the page size and defaults to calendar_page_size,
+                or to limit when that is smaller
+        """
+        if limit is None:
+            yield from self._calendar_event_pages(calendar_id, prefetch=prefetch, **kwargs)
+            return
+
+        kwargs.setdefault('maxResults', min(limit, self.calendar_page_size))
+        # Nothing to prefetch when the first page already holds every event wanted
+        prefetch = prefetch and limit > kwargs['maxResults']
+        with contextlib.closing(self._calendar_event_pages(calendar_id, prefetch=prefetch, **kwargs)) as events:
+            yield from itertools.islice(events, limit)
+
+    def _calendar_event_pages(self, calendar_id, full_sync=False, prefetch=True, **kwargs):
+        """ Yields the events of every page, returns the nextSyncToken of the last page. """
+        kwargs.setdefault('maxResults', self.calendar_page_size)
+
+        sync_token = None
+        pages = self._list_pages(self.calendar_service.events(), prefetch=prefetch, calendarId=calendar_id, **kwargs)
+        for page in pages:
+            sync_token = page.get('nextSyncToken', sync_token)
+            for item in page.get('items', []):
+                yield self._calendar_event(calendar_id, item, full_sync=full_sync)
+        return sync_token
+
+    def sync_calendar_events(self, calendar_id, **kwargs):
+        """ Yields every event of the calendar changed since the last completed sync, see _checkpointed_sync.
+
+        Deleted events are yielded with status 'cancelled'. The first sync, or one whose token
+        Calendar expired with 410 Gone, yields every event with full_sync set.
+
+        References:
+            https://developers.google.com/calendar/api/guides/sync
 
+        Args:
+            calendar_id: Calendar ID to sync
+            **kwargs: see get_calendar_events, those not allowed with a sync token only apply
+                to the full sync
+
+        Raises:
+            ValueError: the provider has no Service to keep the checkpoint for
         """
-        # TODO: Needs more work on the dict idea
-        items = self.calendar_service.events().list(calendarId=calendar_id, *args, **kwargs).execute()
-        for item in items.get('items', []):
-            yield service_objects.CalendarEvent(
-                id=item['id'],
-                calendar_id=calendar_id,
-                link=item['htmlLink'],
-                name=item['summary'],
-                location=item['location'],
-                description=item['description'],
-                start=timezone.make_aware(
-                    dateutil.parser.parse(item['start']['dateTime']),
-                    pytz.timezone(item['start']['timeZone'])
-                ),
-                end=timezone.make_aware(
-                    dateutil.parser.parse(item['end']['dateTime']),
-                    pytz.timezone(item['end']['timeZone'])
-                ),
-                raw=item,
-            )
+        return self._checkpointed_sync(
+            'calendar',
+            calendar_id,
+            lambda sync_token: self._sync_calendar_events(calendar_id, sync_token, **kwargs),
+        )
+
+    def _sync_calendar_events(self, calendar_id, sync_token, **kwargs):
+        if sync_token:
+            params = {k: v for k, v in kwargs.items() if k not in CALENDAR_FULL_SYNC_PARAMS}
+            try:
+                return (yield from self._calendar_event_pages(calendar_id, syncToken=sync_token, **params))
+            except HttpError as e:
+                if e.resp.status != 410:
+                    raise
+
+        return (yield from self._calendar_event_pages(calendar_id, full_sync=True, **kwargs))
+
+    @staticmethod
+    def _calendar_event_time(value):
+        """ Aware datetime of a timed event, date of an all day event, None when missing. """
+        if not value:
+            return None
+        if 'dateTime' in value:
+            start = dateutil.parser.parse(value['dateTime'])
+            tz = pytz.timezone(value['timeZone']) if value.get('timeZone') else None
+            if timezone.is_naive(start):
+                return (tz or pytz.utc).localize(start)
+            return start.astimezone(tz) if tz else start
+        if 'date' in value:
+            return dateutil.parser.parse(value['date']).date()
+
+    def _calendar_event(self, calendar_id, item, full_sync=False):
+        return service_objects.CalendarEvent(
+            id=item['id'],
+            calendar_id=calendar_id,
+            status=item.get('status'),
+            link=item.get('htmlLink'),
+            name=item.get('summary'),
+            location=item.get('location'),
+            description=item.get('description'),
+            start=self._calendar_event_time(item.get('start')),
+            end=self._calendar_event_time(item.get('end')),
+            all_day='date' in item.get('start', {}),
+            full_sync=full_sync,
+            raw=item,
+        )
 
     @staticmethod
     def format_calendaritem_details(event):
@@ -228,5 +735,43 @@ class GoogleServiceProvider(ServiceProvider):
     def get_gmail_helper(self):
         return GmailHelper(self.gmail_service)
 
+    def sync_gmail(self, history_types=None, label_id=None):
+        """ Yields a GmailChange for every message change since the last completed sync, see _checkpointed_sync.
+
+        The first sync, or one whose history id expired, lists every message as an added change
+        with full_sync set.
+
+        References:
+            https://developers.google.com/gmail/api/guides/sync
+
+        Raises:
+            ValueError: the provider has no Service to keep the checkpoint for
+        """
+        return self._checkpointed_sync(
+            'gmail',
+            '',
+            lambda history_id: self._sync_gmail(history_id, history_types, label_id),
+        )
+
+    def _sync_gmail(self, history_id, history_types=None, label_id=None):
+        helper = self.get_gmail_helper()
+
+        if history_id:
+            try:
+                return (yield from helper.changes(history_id, history_types, label_id))
+            except GmailHistoryExpired:
+                pass
+
+        history_id = helper.profile()['historyId']
+        for items in helper.message_pages(label_ids=[label_id] if label_id else None):
+            for item in items:
+                yield GmailChange(
+                    action=GmailChange.ADDED,
+                    message_id=item['id'],
+                    thread_id=item.get('threadId'),
+                    full_sync=True,
+                )
+        return history_id
+
     def get_youtube_helper(self):
         return YouTubeHelper(self.youtube_service)
@@ -1,10 +1,10 @@
 import dateutil.parser
 import pytz
-import requests
 
 from django.utils import timezone
 
 from .. import service_objects
+from ..transport import get_http_session
 from .base import ServiceProvider
 
 
@@ -25,7 +25,7 @@ class MicrosoftServiceProvider(ServiceProvider):
         if not headers:
             kwargs['headers'] = {}
         kwargs['headers']['Authorization'] = self.credentials.token
-        r = requests.request(
+        r = get_http_session().request(
             method=method,
             url=f'{self.graph_url}{url}',
             **kwargs
@@ -1,12 +1,25 @@
-import requests
 from requests.auth import HTTPBasicAuth
-from google.auth.transport.requests import Request
 
 from django.utils import timezone
 
+from ..transport import SharedSessionRequest
 from .base import ServiceProvider
 
 
+class RedditTokenRequest(SharedSessionRequest):
+    """ Token refresh request sending Reddit's required User-Agent and client basic auth per call. """
+
+    def __init__(self, user_agent, auth):
+        super().__init__()
+        self.user_agent = user_agent
+        self.auth = auth
+
+    def __call__(self, url, method='GET', body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        headers['User-Agent'] = self.user_agent
+        return super().__call__(url, method=method, body=body, headers=headers, auth=self.auth, **kwargs)
+
+
 class RedditServiceProvider(ServiceProvider):
     provider_id = 'reddit'
     provider_name = 'Reddit'
@@ -20,14 +33,11 @@ class RedditServiceProvider(ServiceProvider):
     def _refresh_token(self, credentials):
         print('Refreshing', self.account, self.account.provider)
 
-        with requests.Session() as session:
-            session.headers = {
-                'User-Agent': self.user_agent,
-                'Authorization': f'Bearer {credentials.client_secret}',
-            }
-            session.auth = HTTPBasicAuth(credentials.client_id, credentials.client_secret)
-            req = Request(session)
-            credentials.refresh(req)
+        req = RedditTokenRequest(
+            user_agent=self.user_agent,
+            auth=HTTPBasicAuth(credentials.client_id, credentials.client_secret),
+        )
+        credentials.refresh(req)
 
         if credentials.expiry:
             self.token.expires_at = timezone.make_aware(credentials.expiry)
@@ -8,6 +8,16 @@ class Base(object):
         return self.__dict__
 
 
+class FileChange(Base):
+    file_id = None
+    removed = False
+    file = None
+    changed = None
+    full_sync = False
+
+    raw = None
+
+
 class Calendar(Base):
     id = None
     name = None
@@ -22,11 +32,14 @@ class Calendar(Base):
 class CalendarEvent(Base):
     id = None
     calendar_id = None
+    status = None
     name = None
     link = None
     start = None
     end = None
     location = None
     description = None
+    all_day = False
+    full_sync = False
 
     raw = None
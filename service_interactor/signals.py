@@ -1,15 +1,25 @@
 import logging
+from functools import partial
 
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
 from allauth.socialaccount.signals import (
     pre_social_login,
     social_account_added,
 )
 
+from .caches import (
+    bump_account_scope_version,
+    clear_social_apps,
+    invalidate_scope_catalog,
+    scope_catalog,
+)
+from .loaders import clear_registry_snapshot
 from .models import Scope, Service, UserProviderScope
 
 
@@ -67,7 +77,8 @@ def copy_default_scopes(request, sociallogin, **kwargs):
             elif scope == 'profile':
                 scope = 'https://www.googleapis.com/auth/userinfo.profile'
 
-        scope, _ = Scope.objects.get_or_create(provider=sociallogin.account.provider, name=scope)
+        scope = scope_catalog.get(sociallogin.account.provider, scope) or \
+            Scope.objects.get_or_create(provider=sociallogin.account.provider, name=scope)[0]
 
         ups, created = UserProviderScope.objects.get_or_create(account=sociallogin.account, scope=scope)
 
@@ -82,3 +93,31 @@ def copy_default_scopes(request, sociallogin, **kwargs):
 
 
 pre_social_login.connect(copy_default_scopes)
+
+
+post_save.connect(clear_social_apps, sender=SocialApp)
+post_delete.connect(clear_social_apps, sender=SocialApp)
+
+post_save.connect(bump_account_scope_version, sender=UserProviderScope)
+post_delete.connect(bump_account_scope_version, sender=UserProviderScope)
+
+post_save.connect(invalidate_scope_catalog, sender=Scope)
+post_delete.connect(invalidate_scope_catalog, sender=Scope)
+
+
+def clear_user_registry_snapshot(sender, instance, **kwargs):
+    if sender in (Service, SocialAccount):
+        user_id = instance.user_id
+    else:
+        try:
+            user_id = instance.account.user_id
+        except SocialAccount.DoesNotExist:
+            # The account is being deleted, its own post_delete clears the snapshot.
+            return
+    # After the commit, otherwise a concurrent request could cache the rows from before it
+    transaction.on_commit(partial(clear_registry_snapshot, user_id))
+
+
+for model in (Service, SocialAccount, SocialToken, UserProviderScope):
+    post_save.connect(clear_user_registry_snapshot, sender=model)
+    post_delete.connect(clear_user_registry_snapshot, sender=model)
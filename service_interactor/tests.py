@@ -0,0 +1,531 @@
+import base64
+import datetime
+import email
+import email.policy
+import gc
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from email.message import EmailMessage
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+import httplib2
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from asgiref.sync import sync_to_async
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence, HttpRequest
+
+from . import discovery
+from .caches import (
+    DriveFolderIndex,
+    ScopeCatalog,
+    clear_social_apps,
+    get_social_app,
+    scope_catalog,
+)
+from .downloads import DriveDownloadManager
+from .helpers import GmailHelper, GmailMessage, MessageAttachment
+from .loaders import aload_user_services, load_services, load_user_services
+from .models import Scope, Service, SyncCheckpoint, UserProviderScope
+from .providers import GoogleServiceProvider
+from .transport import get_http_session
+from .utils import refresh_expiring_tokens
+
+
+class GoogleAccountTestCase(TestCase):
+    """ A user with a Google SocialApp and SocialAccount, SocialApps are reloaded for every test. """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create(username='user')
+        cls.app = SocialApp.objects.create(provider='google', name='Google', client_id='id', secret='secret')
+        cls.account = SocialAccount.objects.create(user=cls.user, provider='google', uid='1')
+
+    def setUp(self):
+        clear_social_apps()
+
+
+class LoadServicesTests(GoogleAccountTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.scope = Scope.objects.create(
+            provider='google', name='https://www.googleapis.com/auth/drive', grants_access=True, access_type='files',
+        )
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        scope_catalog.invalidate()
+        # SocialApps come from the process cache, see caches.get_social_app
+        get_social_app('google')
+
+    def add_services(self, count):
+        for i in range(Service.objects.filter(user=self.user).count(), count):
+            account = SocialAccount.objects.create(user=self.user, provider='google', uid=f'service-{i}')
+            SocialToken.objects.create(app=self.app, account=account, token='token', token_secret='secret')
+            UserProviderScope.objects.create(account=account, scope=self.scope)
+            Service.objects.create(user=self.user, account=account)
+
+    def load(self):
+        services = load_services(Service.objects.filter(user=self.user))
+        for service in services:
+            provider = service.get_service_provider()
+            provider.is_enabled
+            provider.get_account_scope_objects()
+        return services
+
+    def test_query_count_does_not_grow_with_services(self):
+        self.add_services(1)
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.load()), 1)
+
+        self.add_services(5)
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.load()), 5)
+
+    def test_no_services(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(load_services(Service.objects.filter(user=self.user)), [])
+
+    @override_settings(SERVICE_INTERACTOR_REGISTRY_CACHE=True)
+    def test_snapshot_is_loaded_without_queries(self):
+        self.add_services(3)
+        load_user_services(self.user)
+
+        with self.assertNumQueries(0):
+            services = load_user_services(self.user)
+            self.assertEqual(len(services), 3)
+            for service in services:
+                provider = service.get_service_provider()
+                self.assertTrue(provider.is_enabled)
+                self.assertTrue(provider.has_file_access)
+                self.assertFalse(provider.has_calendar_access)
+                str(service)
+
+    def test_scope_catalog_is_invalidated_after_commit(self):
+        version = scope_catalog.version
+        with self.captureOnCommitCallbacks(execute=True):
+            Scope.objects.create(provider='google', name='https://www.googleapis.com/auth/calendar')
+            self.assertEqual(scope_catalog.version, version)
+        self.assertNotEqual(scope_catalog.version, version)
+        self.assertIsNotNone(scope_catalog.get('google', 'https://www.googleapis.com/auth/calendar'))
+
+    @override_settings(SERVICE_INTERACTOR_REGISTRY_CACHE=True)
+    def test_snapshot_is_cleared_when_services_change(self):
+        self.add_services(1)
+        load_user_services(self.user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_services(2)
+            # Until the commit other requests would still read the old rows
+            self.assertEqual(len(load_user_services(self.user)), 1)
+        self.assertEqual(len(load_user_services(self.user)), 2)
+
+    @override_settings(SERVICE_INTERACTOR_REGISTRY_CACHE=True)
+    async def test_async_snapshot_only_uses_the_async_catalog(self):
+        await sync_to_async(self.add_services)(2)
+
+        # The synchronous version check would block the event loop
+        with mock.patch.object(ScopeCatalog, '_ensure_loaded', side_effect=AssertionError('sync catalog load')):
+            services = await aload_user_services(self.user)
+            cached = await aload_user_services(self.user)
+
+        self.assertEqual(len(services), 2)
+        self.assertEqual([s.pk for s in cached], [s.pk for s in services])
+        self.assertTrue(cached[0].get_service_provider().has_file_access)
+
+
+@mock.patch('service_interactor.utils._refresh_service_token')
+class RefreshExpiringTokensTests(GoogleAccountTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Tokens are unique per app and account, an older client app keeps the older token
+        cls.old_app = SocialApp.objects.create(provider='google-old', name='Old', client_id='id', secret='secret')
+
+    def add_token(self, expires_in, app=None):
+        return SocialToken.objects.create(
+            app=app or self.app, account=self.account, token='token', token_secret='secret',
+            expires_at=timezone.now() + expires_in,
+        )
+
+    def refreshed(self, refresh):
+        return [c.args[2] for c in refresh.call_args_list]
+
+    def test_older_expiring_token_is_ignored(self, refresh):
+        self.add_token(datetime.timedelta(minutes=1), app=self.old_app)
+        self.add_token(datetime.timedelta(hours=1))
+
+        self.assertEqual(refresh_expiring_tokens(), {})
+        refresh.assert_not_called()
+
+    def test_newest_expiring_token_is_refreshed(self, refresh):
+        self.add_token(datetime.timedelta(minutes=-30), app=self.old_app)
+        newest = self.add_token(datetime.timedelta(minutes=1))
+
+        self.assertEqual(refresh_expiring_tokens(), {'google': {'refreshed': 1, 'failed': 0}})
+        self.assertEqual(self.refreshed(refresh), [newest])
+
+
+class DiscoveryDocumentTests(TestCase):
+
+    def setUp(self):
+        discovery.clear_discovery_documents()
+        self.addCleanup(discovery.clear_discovery_documents)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.chmod(self.directory, 0o700)
+        with open(os.path.join(self.directory, 'drive.v3.json'), 'w') as fo:
+            fo.write('{"rootUrl": "https://attacker.example/"}')
+
+    def test_static_document_is_used_before_the_disk_cache(self):
+        with override_settings(SERVICE_INTERACTOR_DISCOVERY_CACHE_DIR=self.directory):
+            document = discovery.get_discovery_document('drive', 'v3')
+        self.assertEqual(document['rootUrl'], 'https://www.googleapis.com/')
+
+    @override_settings(SERVICE_INTERACTOR_DISCOVERY_STATIC_DOCUMENTS=False)
+    def test_disk_cache_writable_by_others_is_ignored(self):
+        os.chmod(self.directory, 0o777)
+        with override_settings(SERVICE_INTERACTOR_DISCOVERY_CACHE_DIR=self.directory), \
+                mock.patch.object(discovery, '_fetch_document', return_value='{"rootUrl": "fetched"}'):
+            document = discovery.get_discovery_document('drive', 'v3')
+        self.assertEqual(document['rootUrl'], 'fetched')
+
+    @override_settings(SERVICE_INTERACTOR_DISCOVERY_STATIC_DOCUMENTS=False)
+    def test_private_disk_cache_is_used(self):
+        with override_settings(SERVICE_INTERACTOR_DISCOVERY_CACHE_DIR=self.directory), \
+                mock.patch.object(discovery, '_fetch_document') as fetch:
+            document = discovery.get_discovery_document('drive', 'v3')
+        fetch.assert_not_called()
+        self.assertEqual(document['rootUrl'], 'https://attacker.example/')
+
+
+class SyncCheckpointTests(GoogleAccountTestCase):
+
+    def test_sync_without_service_fails_before_any_request(self):
+        provider = GoogleServiceProvider(account=self.account)
+        with mock.patch.object(GoogleServiceProvider, 'resource') as resource:
+            with self.assertRaises(ValueError):
+                provider.sync_gmail()
+            with self.assertRaises(ValueError):
+                provider.sync_drive()
+            with self.assertRaises(ValueError):
+                provider.sync_calendar_events('primary')
+        resource.assert_not_called()
+
+    def test_checkpoint_moves_forward_once_consumed(self):
+        provider = Service.objects.create(user=self.user, account=self.account).get_service_provider()
+        received = []
+
+        def sync(checkpoint):
+            received.append(checkpoint)
+            yield 'change'
+            return f'{checkpoint or ""}+'
+
+        list(provider._checkpointed_sync(SyncCheckpoint.DRIVE, 'default', sync))
+        next(provider._checkpointed_sync(SyncCheckpoint.DRIVE, 'default', sync))
+        list(provider._checkpointed_sync(SyncCheckpoint.DRIVE, 'default', sync))
+        list(provider._checkpointed_sync(SyncCheckpoint.DRIVE, 'other', sync))
+
+        self.assertEqual(received, [None, '+', '+', None])
+        self.assertEqual(
+            dict(SyncCheckpoint.objects.values_list('key', 'value')),
+            {'default': '++', 'other': '+'},
+        )
+
+
+class ShortReadStream(io.RawIOBase):
+    """ Returns at most 1000 bytes per read, like a socket or pipe. """
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 1000) if size >= 0 else 1000)
+
+
+class SendMessageTests(TestCase):
+
+    def setUp(self):
+        self.helper = GmailHelper(service=None)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_file(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as fo:
+            fo.write(data)
+        return path
+
+    def parse(self, fo):
+        return email.message_from_binary_file(fo, policy=email.policy.default)
+
+    def test_short_reads_are_encoded_without_padding_in_the_body(self):
+        data = os.urandom(50000)
+        attachment = MessageAttachment('data.bin', ShortReadStream(data))
+
+        with self.helper.build_message_file('to@example.com', 'Subject', 'Body', [attachment]) as fo:
+            message = self.parse(fo)
+
+        part = list(message.iter_attachments())[0]
+        self.assertEqual(part.get_filename(), 'data.bin')
+        self.assertEqual(part.get_content(), data)
+        self.assertEqual(part.defects, [])
+
+    def test_tuple_of_paths(self):
+        first = self.write_file('first.bin', b'first')
+        second = self.write_file('second.bin', b'second')
+
+        message = self.helper.send_message('to@example.com', 'Subject', 'Body', attachments=(first, second), send=False)
+        self.assertEqual([part.get_filename() for part in message.get_payload()[1:]], ['first.bin', 'second.bin'])
+
+        with self.helper.build_message_file('to@example.com', 'Subject', 'Body', [first, second]) as fo:
+            attachments = list(self.parse(fo).iter_attachments())
+        self.assertEqual([part.get_content() for part in attachments], [b'first', b'second'])
+
+    def test_named_attachment(self):
+        path = self.write_file('report.bin', b'data')
+        attachments = [MessageAttachment('renamed.bin', path), MessageAttachment('stream.bin', io.BytesIO(b'stream'))]
+
+        with self.helper.build_message_file('to@example.com', 'Subject', 'Body', attachments) as fo:
+            parts = list(self.parse(fo).iter_attachments())
+        self.assertEqual([(p.get_filename(), p.get_content()) for p in parts], [
+            ('renamed.bin', b'data'), ('stream.bin', b'stream'),
+        ])
+
+
+def batch_response(*parts):
+    """ HttpMockSequence response of a batch request, parts are (request_id, status, body). """
+    body = ''.join(
+        f'--batch\r\nContent-Type: application/http\r\nContent-ID: <response-id + {request_id}>\r\n\r\n'
+        f'HTTP/1.1 {status} Status\r\nContent-Type: application/json\r\n\r\n{content}\r\n'
+        for request_id, status, content in parts
+    )
+    return {'status': '200', 'content-type': 'multipart/mixed; boundary=batch'}, f'{body}--batch--'
+
+
+class BatchLoadTests(TestCase):
+
+    def test_rate_limited_gets_are_retried(self):
+        http = HttpMockSequence([
+            ({'status': '200'}, '{"messages": [{"id": "1"}, {"id": "2"}, {"id": "3"}]}'),
+            batch_response(
+                ('1', 200, '{"id": "1"}'),
+                ('2', 429, '{"error": {"code": 429}}'),
+                ('3', 200, '{"id": "3"}'),
+            ),
+            batch_response(('2', 200, '{"id": "2"}')),
+        ])
+        helper = GmailHelper(build('gmail', 'v1', http=http, static_discovery=True))
+        helper.batch_retry_delay = 0
+
+        self.assertEqual([message.id for message in helper.messages(batch_size=100)], ['1', '2', '3'])
+
+    def test_permanent_errors_are_raised(self):
+        http = HttpMockSequence([
+            ({'status': '200'}, '{"messages": [{"id": "1"}]}'),
+            batch_response(('1', 404, '{"error": {"code": 404}}')),
+        ])
+        helper = GmailHelper(build('gmail', 'v1', http=http, static_discovery=True))
+
+        with self.assertRaises(HttpError):
+            list(helper.messages(batch_size=100))
+
+
+class BatchLabelTests(TestCase):
+
+    def test_single_label_ids(self):
+        service = mock.Mock()
+        GmailHelper(service).batch_label_manager(['1', '2'], label_ids='Label_1', remove_ids='Label_5')
+        service.users().messages().batchModify.assert_called_once_with(userId='me', body={
+            'addLabelIds': ['Label_1'],
+            'removeLabelIds': ['Label_5', 'INBOX'],
+            'ids': ['1', '2'],
+        })
+
+
+class ResumeDownloadTests(GoogleAccountTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.provider = GoogleServiceProvider(account=self.account)
+        self.remote = b'0123456789'
+
+    def request(self, *responses):
+        return HttpRequest(HttpMockSequence(list(responses)), lambda resp, content: content, 'https://drive/file')
+
+    def details(self, data):
+        return {'size': str(len(data)), 'md5Checksum': hashlib.md5(data).hexdigest()}
+
+    def download(self, local, *responses):
+        fh = io.BytesIO(local)
+        fh.seek(0, os.SEEK_END)
+        with mock.patch.object(GoogleServiceProvider, 'get_file_details', return_value=self.details(self.remote)):
+            self.provider._write_media(
+                self.request(*responses), fh, start=fh.tell(),
+                verify=lambda fh, size: self.provider._is_complete_copy('file', fh, size),
+            )
+        return fh.getvalue()
+
+    def test_complete_copy_is_kept(self):
+        gone = ({'status': '416', 'content-range': 'bytes */10'}, b'')
+        self.assertEqual(self.download(self.remote, gone), self.remote)
+
+    def test_different_copy_is_downloaded_again(self):
+        gone = ({'status': '416', 'content-range': 'bytes */10'}, b'')
+        full = ({'status': '206', 'content-range': 'bytes 0-9/10'}, self.remote)
+        self.assertEqual(self.download(b'abcdefghij', gone, full), self.remote)
+
+    def test_longer_copy_is_downloaded_again(self):
+        gone = ({'status': '416', 'content-range': 'bytes */10'}, b'')
+        full = ({'status': '206', 'content-range': 'bytes 0-9/10'}, self.remote)
+        self.assertEqual(self.download(self.remote + b'extra', gone, full), self.remote)
+
+
+class DownloadRetryTests(TestCase):
+
+    def error(self, status, content=b''):
+        return HttpError(httplib2.Response({'status': status}), content)
+
+    def download(self, *errors):
+        provider = mock.Mock()
+        provider.download_file.side_effect = list(errors) + [None]
+        manager = DriveDownloadManager(provider, directory=tempfile.gettempdir(), retries=3)
+        manager.retry_delay = 0
+        return manager.download(['file'])['file']
+
+    def test_transient_errors_are_retried(self):
+        rate_limited = self.error(403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}')
+        result = self.download(self.error(503), self.error(429), rate_limited)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.attempts, 4)
+
+    def test_permanent_errors_fail_immediately(self):
+        for error in (self.error(404), self.error(403), OSError('disk full')):
+            with self.subTest(error=error):
+                result = self.download(error)
+                self.assertIs(result.error, error)
+                self.assertEqual(result.attempts, 1)
+
+
+class DriveFolderIndexTests(TestCase):
+
+    def test_readers_get_copies(self):
+        index = DriveFolderIndex('root', [{'id': 'a', 'name': 'a', 'parents': ['root']}])
+        folders, children = index.all(), index.children('root')
+        index.add({'id': 'b', 'name': 'b', 'parents': ['root']})
+        self.assertEqual([folder['id'] for folder in folders], ['a'])
+        self.assertEqual([folder['id'] for folder in children], ['a'])
+        self.assertEqual(len(index.all()), 2)
+
+
+class CalendarEventsTests(GoogleAccountTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.provider = GoogleServiceProvider(account=self.account)
+
+    def pages(self, resource, prefetch=True, **kwargs):
+        self.requests.append(dict(kwargs, prefetch=prefetch))
+        for page in range(3):
+            yield {'items': [{'id': f'{page}-{item}'} for item in range(kwargs['maxResults'])]}
+
+    def events(self, **kwargs):
+        self.requests = []
+        with mock.patch.object(GoogleServiceProvider, 'calendar_service'), \
+                mock.patch.object(GoogleServiceProvider, '_list_pages', side_effect=self.pages):
+            return [event.id for event in self.provider.get_calendar_events('primary', **kwargs)]
+
+    def test_limit_stops_paging(self):
+        self.assertEqual(self.events(limit=3), ['0-0', '0-1', '0-2'])
+        self.assertEqual(self.requests[0]['maxResults'], 3)
+        self.assertFalse(self.requests[0]['prefetch'])
+
+    def test_limit_across_pages(self):
+        self.assertEqual(self.events(limit=3, maxResults=2), ['0-0', '0-1', '1-0'])
+        self.assertTrue(self.requests[0]['prefetch'])
+
+    def test_every_event_without_limit(self):
+        self.assertEqual(len(self.events(maxResults=2)), 6)
+
+
+class SharedSessionTests(GoogleAccountTestCase):
+
+    def test_refresh_keeps_the_connection_pools(self):
+        provider = GoogleServiceProvider(account=self.account)
+        provider.token = SocialToken.objects.create(
+            app=self.app, account=self.account, token='old', token_secret='refresh',
+        )
+
+        pools = get_http_session().get_adapter('https://').poolmanager.pools
+        get_http_session().get_adapter('https://').poolmanager.connection_from_url('https://oauth2.googleapis.com')
+
+        credentials = mock.Mock(token='new', expiry=None, refresh_token=None)
+        provider._refresh_token(credentials)
+        credentials.refresh.assert_called_once()
+        del credentials
+        gc.collect()
+
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(SocialToken.objects.get().token, 'new')
+
+
+class MessageAttachmentsTests(TestCase):
+
+    def setUp(self):
+        inner = EmailMessage()
+        inner.set_content('inner')
+        inner.add_attachment(b'inner pdf', maintype='application', subtype='pdf', filename='inner.pdf')
+        outer = EmailMessage()
+        outer.set_content('outer')
+        outer.add_attachment(b'top pdf', maintype='application', subtype='pdf', filename='top.pdf')
+        outer.attach(inner)
+        raw = base64.urlsafe_b64encode(outer.as_bytes()).decode('ascii')
+        self.message = GmailMessage(None, {'id': '1', 'raw': raw}, format=GmailMessage.FORMAT_RAW)
+
+    def test_raw_message_finds_nested_attachments(self):
+        self.assertEqual(
+            [(attachment['name'], attachment['data']) for attachment in self.message.attachments()],
+            [('top.pdf', b'top pdf'), ('inner.pdf', b'inner pdf')],
+        )
+
+    def test_raw_message_downloads_nested_attachments(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        saved = []
+        for attachment, path in self.message.download_attachments(directory):
+            with open(path, 'rb') as fo:
+                saved.append((attachment.filename, fo.read()))
+        self.assertEqual(saved, [('top.pdf', b'top pdf'), ('inner.pdf', b'inner pdf')])
+
+    def test_attachments_with_the_same_name_get_their_own_file(self):
+        message = EmailMessage()
+        message.set_content('body')
+        for data in (b'first', b'second'):
+            message.add_attachment(data, maintype='image', subtype='png', filename='image.png')
+        raw = base64.urlsafe_b64encode(message.as_bytes()).decode('ascii')
+        message = GmailMessage(None, {'id': '2', 'raw': raw}, format=GmailMessage.FORMAT_RAW)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        paths = [path for _, path in message.download_attachments(directory, max_workers=2)]
+        self.assertEqual([os.path.basename(path) for path in paths], ['image.png', '1-image.png'])
+        contents = []
+        for path in paths:
+            with open(path, 'rb') as fo:
+                contents.append(fo.read())
+        self.assertEqual(contents, [b'first', b'second'])
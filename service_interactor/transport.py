@@ -0,0 +1,102 @@
+import requests
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+
+from google.auth.transport.requests import Request
+
+from .app_settings import app_settings
+
+
+class _RejectCookiesPolicy(DefaultCookiePolicy):
+    """ The shared session is used for many accounts, never keep cookies between them. """
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """ Process wide requests.Session with a keep-alive connection pool per host.
+
+    Pool sizes come from the HTTP_POOL_CONNECTIONS and HTTP_POOL_MAXSIZE settings. Only pass
+    per-request headers and auth to it, changing the session itself affects every caller.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.cookies.set_policy(_RejectCookiesPolicy())
+                adapter = HTTPAdapter(
+                    pool_connections=app_settings.HTTP_POOL_CONNECTIONS,
+                    pool_maxsize=app_settings.HTTP_POOL_MAXSIZE,
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class SharedSessionRequest(Request):
+    """ google-auth transport over get_http_session for token refreshes.
+
+    google-auth closes the session of a Request once it is garbage collected, which would empty
+    the keep-alive pools every caller shares, so this one leaves the session open.
+    """
+
+    def __init__(self):
+        super().__init__(session=get_http_session())
+
+    def __del__(self):
+        pass
+
+
+class AuthorizedHttp:
+    """ httplib2 compatible transport shared by every googleapiclient service of one provider.
+
+    Each thread gets its own httplib2.Http, they are not thread-safe, which is reused for
+    every Google API the provider calls. Credentials come from provider.refresh_credentials
+    so refreshed tokens are saved the same way as ServiceProvider.credentials does.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self._local = threading.local()
+
+    @property
+    def http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            from googleapiclient.http import build_http
+            http = self._local.http = build_http()
+        return http
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        credentials = self.provider.refresh_credentials()
+
+        for retry in (True, False):
+            request_headers = dict(headers or {})
+            credentials.apply(request_headers)
+
+            response, content = self.http.request(uri, method, body=body, headers=request_headers, **kwargs)
+
+            if response.status != 401 or not retry:
+                break
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            credentials = self.provider.refresh_credentials(rejected=True)
+
+        return response, content
+
+    def close(self):
+        http = getattr(self._local, 'http', None)
+        if http is not None:
+            http.close()
+            self._local.http = None
@@ -1,26 +1,49 @@
 import datetime
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.db import connections
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
 
 import dateutil.parser
 
 
-def get_takeout_files(provider, include_details=True, allow_over_10mb=False):
+log = logging.getLogger('service_interactor.utils')
+
+
+def get_takeout_files(provider, include_details=True, allow_over_10mb=False, incremental=False):
+    """ Google Takeout archives in the users Drive.
+
+    Args:
+        incremental: only return archives added or changed since the last incremental call,
+            see GoogleServiceProvider.sync_drive, the first call returns every archive
+    """
     files = {}
     this_yearmonth = datetime.datetime.now().strftime('%Y%m')
 
     # Only zip files and files dated this year and month at minimum
-    for file in provider.get_files(
-            orderBy='createdTime desc',
-            q=f"mimeType='application/x-zip' and name contains 'takeout-{this_yearmonth}'"
-    ):
+    fields = 'id, name, mimeType, size, createdTime'
+    q = f"mimeType='application/x-zip' and name contains 'takeout-{this_yearmonth}'"
+
+    if incremental:
+        found = (
+            change.file for change in provider.sync_drive(name='takeout', fields=fields, q=q)
+            if not change.removed and change.file
+            and change.file.get('mimeType') == 'application/x-zip'
+            and f'takeout-{this_yearmonth}' in change.file.get('name', '')
+        )
+    else:
+        found = provider.get_files(fields=fields, orderBy='createdTime desc', q=q)
+
+    for file in found:
 
         if include_details:
-            try:
-                details = provider.get_file_details(file_id=file['id'], fields='size,createdTime')
-                file['created'] = dateutil.parser.parse(details['createdTime'])
-                file['size'] = round(int(details.get('size')) / 1000 / 1000, 2)
-            except:  # noqa
-                file['created'] = None
-                file['size'] = None
+            # size and createdTime come with the listing, no per file request is needed
+            created, size = file.pop('createdTime', None), file.pop('size', None)
+            file['created'] = dateutil.parser.parse(created) if created else None
+            file['size'] = round(int(size) / 1000 / 1000, 2) if size else None
 
             if not allow_over_10mb and file['size'] and file['size'] > 10.0:
                 continue
@@ -28,3 +51,74 @@ def get_takeout_files(provider, include_details=True, allow_over_10mb=False):
         files[file['id']] = file
 
     return files
+
+
+def run_in_worker(fn, *args, **kwargs):
+    """ Calls fn in a worker thread, closing the database connections the call opened in that thread. """
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def _refresh_service_token(provider_class, client, token, window):
+    provider = provider_class(account=token.account, client=client)
+    provider.token = token
+    provider.refresh_credentials(force=True, leeway=window)
+
+
+def refresh_expiring_tokens(window=datetime.timedelta(minutes=15), max_workers=4, providers=None):
+    """ Refreshes every SocialToken expiring within window ahead of time.
+
+    Tokens are grouped per provider and refreshed in parallel through the same single-flight
+    path as ServiceProvider.credentials, so it is safe to run alongside web workers.
+
+    Args:
+        window: timedelta, tokens expiring before now + window are refreshed
+        max_workers: maximum parallel refreshes per provider
+        providers: list of provider ids to limit the refresh to
+
+    Returns:
+        dict of provider id to {'refreshed': int, 'failed': int}
+    """
+    from allauth.socialaccount.models import SocialToken
+
+    from .caches import get_social_app
+    from .models import SERVICE_PROVIDER_CLASSES
+
+    provider_ids = [pid for pid, cls in SERVICE_PROVIDER_CLASSES.items() if cls.token_uri]
+    if providers:
+        provider_ids = [pid for pid in provider_ids if pid in providers]
+
+    # Providers only ever use the newest token of an account, see ServiceProvider._get_social_token
+    newest = SocialToken.objects.filter(account=OuterRef('account')).order_by('-expires_at').values('pk')[:1]
+    tokens = SocialToken.objects.filter(
+        pk=Subquery(newest),
+        account__provider__in=provider_ids,
+        expires_at__lte=timezone.now() + window,
+    ).exclude(token_secret='').select_related('account')
+
+    grouped = defaultdict(list)
+    for token in tokens:
+        grouped[token.account.provider].append(token)
+
+    results = {}
+    for provider_id, provider_tokens in grouped.items():
+        provider_class = SERVICE_PROVIDER_CLASSES[provider_id]
+        client = get_social_app(provider_id)
+        counts = results[provider_id] = {'refreshed': 0, 'failed': 0}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(run_in_worker, _refresh_service_token, provider_class, client, token, window): token
+                for token in provider_tokens
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    counts['refreshed'] += 1
+                except Exception:  # noqa
+                    log.exception('Failed to refresh token %s for %s', futures[future].pk, provider_id)
+                    counts['failed'] += 1
+
+    return results